@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Optional, Tuple
+
+from _metrics import cache_requests
+from _redis import delete_key, get_key, redis_client, set_key
+from _singleflight import SingleFlight
+from _utils import spawn
+
+logger = logging.getLogger(__name__)
+
+CACHE_REFRESH_LOCK_TTL = int(os.getenv("CACHE_REFRESH_LOCK_TTL", 30))
+# 超过 hard ttl 后 redis 中继续保留的时间，上游失败或熔断时用来兜底
+CACHE_STALE_IF_ERROR = int(os.getenv("CACHE_STALE_IF_ERROR", 60 * 60 * 24))
+
+
+class CacheResult:
+    """
+    缓存读取结果
+    :param value: 缓存的数据
+    :param status: HIT | STALE | MISS | EXPIRED（超过 hard ttl，只在上游失败时使用）
+    :param age: 数据的年龄（秒）
+    """
+    __slots__ = ("value", "status", "age")
+
+    def __init__(self, value, status: str, age: int = 0):
+        self.value = value
+        self.status = status
+        self.age = age
+
+    def headers(self) -> dict:
+        """
+        缓存状态响应头
+        :return: dict
+        """
+        return {"X-Cache": self.status, "X-Cache-Age": str(self.age)}
+
+
+class SWRCache:
+    """
+    stale-while-revalidate 缓存，redis 中存储 {"t": 写入时间, "s": soft ttl, "h": hard ttl, "v": 数据}
+    - age < soft_ttl：直接返回（HIT）
+    - soft_ttl <= age < hard_ttl：直接返回旧数据（STALE），后台刷新
+    - 没有缓存或超过 hard_ttl：同步请求上游（MISS），同 key 并发请求会被合并
+    - 上游失败（包括熔断）时，超过 hard_ttl 但还在 stale-if-error 窗口内的数据作为 STALE 返回
+    每个 key 的过期时间从写入开始计算，不再在午夜同时失效
+    ttl 可以是 (soft_ttl, hard_ttl) 或者根据数据计算 ttl 的函数，用于按内容决定缓存时间
+    """
+
+    def __init__(self, namespace: str, soft_ttl: int, hard_ttl: int,
+                 ttl: Optional[Callable[[object], Tuple[int, int]]] = None):
+        self.namespace = namespace
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.ttl = ttl
+        self.flight = SingleFlight(namespace)
+
+    async def read(self, key: str) -> Optional[CacheResult]:
+        """
+        读取缓存，不触发刷新
+        :param key: redis key
+        :return: CacheResult | None
+        """
+        raw = await get_key(key)
+        if not raw:
+            return None
+        try:
+            entry = json.loads(raw)
+            age = max(0, int(time.time() - entry["t"]))
+            value = entry["v"]
+            soft_ttl = entry.get("s", self.soft_ttl)
+            hard_ttl = entry.get("h", self.hard_ttl)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # 旧格式或者损坏的数据，当作没有缓存
+            return None
+        if age >= hard_ttl:
+            return CacheResult(value, "EXPIRED", age)
+        return CacheResult(value, "HIT" if age < soft_ttl else "STALE", age)
+
+    async def _read_usable(self, key: str) -> Optional[CacheResult]:
+        cached = await self.read(key)
+        if cached is None or cached.status == "EXPIRED":
+            return None
+        return cached
+
+    async def write(self, key: str, value) -> bool:
+        """
+        写入缓存
+        :param key: redis key
+        :param value: 可以 json 序列化的数据
+        :return: bool
+        """
+        soft_ttl, hard_ttl = self.ttl(value) if self.ttl else (self.soft_ttl, self.hard_ttl)
+        return await set_key(key, json.dumps({"t": time.time(), "s": soft_ttl, "h": hard_ttl, "v": value}),
+                             ex=hard_ttl + CACHE_STALE_IF_ERROR)
+
+    async def invalidate(self, key: str) -> bool:
+        """
+        删除缓存
+        :param key: redis key
+        :return: bool
+        """
+        return await delete_key(key)
+
+    def revalidate(self, key: str, fetch: Callable[[], Awaitable],
+                   should_cache: Optional[Callable[[object], bool]] = None) -> None:
+        """
+        在后台刷新一个已经读到的 STALE 缓存，不等待上游
+        :param key: redis key
+        :param fetch: 请求上游的协程函数
+        :param should_cache: 判断结果是否需要缓存，默认全部缓存
+        """
+        spawn(self._refresh(key, fetch, should_cache))
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable],
+                           should_cache: Optional[Callable[[object], bool]] = None) -> CacheResult:
+        """
+        读取缓存，未命中时请求上游并写入缓存
+        :param key: redis key
+        :param fetch: 请求上游的协程函数
+        :param should_cache: 判断结果是否需要缓存，默认全部缓存
+        :return: CacheResult
+        """
+        try:
+            result = await self._get_or_fetch(key, fetch, should_cache)
+        except Exception:
+            cache_requests.inc(self.namespace, "ERROR")
+            raise
+        cache_requests.inc(self.namespace, result.status)
+        return result
+
+    async def _get_or_fetch(self, key: str, fetch: Callable[[], Awaitable],
+                            should_cache: Optional[Callable[[object], bool]]) -> CacheResult:
+        try:
+            cached = await self.read(key)
+        except Exception as e:
+            logger.error(f"Failed to read cache {key}: {e}")
+            cached = None
+        if cached is not None and cached.status != "EXPIRED":
+            if cached.status == "STALE":
+                self.revalidate(key, fetch, should_cache)
+            return cached
+
+        async def _load():
+            value = await fetch()
+            if should_cache is None or should_cache(value):
+                await self.write(key, value)
+            return CacheResult(value, "MISS", 0)
+
+        try:
+            return await self.flight.do(key, _load, lookup=lambda: self._read_usable(key))
+        except Exception as e:
+            if cached is None:
+                raise
+            logger.warning(f"Serving expired cache {key} after upstream error: {e}")
+            return CacheResult(cached.value, "STALE", cached.age)
+
+    async def _refresh(self, key: str, fetch: Callable[[], Awaitable],
+                       should_cache: Optional[Callable[[object], bool]]):
+        """
+        后台刷新过期数据，所有 worker 中只有拿到锁的一个会去请求上游
+        """
+        lock_key = f"lock:refresh:{key}"
+        try:
+            if not await redis_client.set(lock_key, uuid.uuid4().hex, nx=True, ex=CACHE_REFRESH_LOCK_TTL):
+                return
+        except Exception as e:
+            logger.error(f"Failed to acquire refresh lock {lock_key}: {e}")
+            return
+        try:
+            value = await fetch()
+            if should_cache is None or should_cache(value):
+                await self.write(key, value)
+        except Exception as e:
+            logger.error(f"Failed to refresh cache {key}: {e}")
+        finally:
+            try:
+                await redis_client.delete(lock_key)
+            except Exception:
+                pass
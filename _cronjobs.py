@@ -1,115 +1,438 @@
+import asyncio
 import json
 import logging
+import os
+import socket
+import time
 from datetime import datetime
+from typing import Optional
 
 from fastapi_utils.tasks import repeat_every
-from httpx import AsyncClient
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
 
-from _db import PushLog, SessionLocal, test_db_connection
+from _db import PushLog, SessionLocal, insert_ignore, test_db_connection, truncate_columns
+from _metrics import Gauge, register_async_collector
 from _redis import delete_key, get_key, get_keys_by_pattern, redis_client, set_key as redis_set_key
+from _push import pushEngine
+from _utils import PUSH_STREAM, PUSH_STREAM_MAXLEN, spawn
 
 logger = logging.getLogger(__name__)
 
+PUSH_GROUP = "pushWorkers"
+PUSH_DEAD_STREAM = f"{PUSH_STREAM}:dead"
+PUSH_CONSUMER = f"{socket.gethostname()}-{os.getpid()}"
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", 50))
+PUSH_BLOCK_MS = int(os.getenv("PUSH_BLOCK_MS", 5000))  # XREADGROUP 阻塞等待新任务的时间
+PUSH_RETRY_IDLE_MS = int(os.getenv("PUSH_RETRY_IDLE_MS", 30 * 1000))  # 未确认的任务闲置多久后重新投递
+PUSH_MAX_DELIVERIES = int(os.getenv("PUSH_MAX_DELIVERIES", 5))  # 超过投递次数进入死信队列
+PUSH_MAX_BUFFERED = int(os.getenv("PUSH_MAX_BUFFERED", 1000))  # 已读取未完成的任务上限，包括等待繁忙 host 的任务
+PUSHLOG_BATCH_SIZE = int(os.getenv("PUSHLOG_BATCH_SIZE", 500))  # 每条 INSERT 写入的推送日志行数
+PUSHLOG_FLUSH_SECONDS = float(os.getenv("PUSHLOG_FLUSH_SECONDS", 2))
+PUSHLOG_MAX_BUFFER = int(os.getenv("PUSHLOG_MAX_BUFFER", 50000))
+PUSHLOG_BACKLOG_KEY = "pushLogs:backlog"
+# 数据库连接类的错误，整批放回缓冲区稍后重试；其他错误（数据过长、外键不存在等）说明行本身有问题
+_TRANSIENT_DB_ERRORS = (OperationalError, InterfaceError, DisconnectionError, PoolTimeoutError, OSError,
+                        asyncio.TimeoutError)
+
+_pushConsumer: Optional[asyncio.Task] = None
+
+
+def _pushLogRow(taskId: str, data: dict) -> dict:
+    """
+    推送任务转成 push_logs 的一行
+    """
+    # 兼容 {"data": {...}, "result": ...} 和 generatePushTask 写入的扁平结构
+    payload = data.get('data', data)
+    logData = payload.get('log_data', {})
+    return truncate_columns(PushLog, {
+        "push_id": taskId,
+        "push_receiver": logData.get('push_receiver'),
+        "push_channel": "bark",
+        "push_at": datetime.now(),
+        "push_by": logData.get('push_by', 'system'),
+        "push_result": data['result'] == 'success',
+        "push_message": payload['msg'],
+        "push_server": 'bark',
+        "user_id": logData.get('user_id'),
+    })
+
+
+class PushLogBuffer:
+    """
+    推送日志写缓冲：攒够 PUSHLOG_BATCH_SIZE 条或每隔 PUSHLOG_FLUSH_SECONDS 秒用一条多行 INSERT 写入
+    - 数据库连接失败时整批放回缓冲区，下次重试；停止时还写不进去的行暂存到 redis，启动时重新载入
+    - 其他错误改为逐行写入，写不进去的行记录日志后丢弃，一行坏数据不会卡住后面所有的日志
+    - push_id 重复的行（任务被重复投递）直接忽略
+    """
+
+    def __init__(self, batch_size: int = PUSHLOG_BATCH_SIZE, max_rows: int = PUSHLOG_MAX_BUFFER):
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self._rows: list = []
+        self._lock = asyncio.Lock()
+        self.flushed = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row: dict):
+        self._rows.append(row)
+        if len(self._rows) > self.max_rows:
+            # MySQL 长时间不可用时限制内存占用，丢弃最旧的记录
+            overflow = len(self._rows) - self.max_rows
+            del self._rows[:overflow]
+            self.dropped += overflow
+            logger.error(f"Push log buffer full, dropped {overflow} oldest rows")
+        if len(self._rows) >= self.batch_size and not self._lock.locked():
+            spawn(self.flush())
+
+    async def flush(self) -> int:
+        """
+        写入缓冲区中的所有记录
+        :return: 写入的行数
+        """
+        async with self._lock:
+            flushed = self.flushed
+            try:
+                while self._rows:
+                    rows = self._rows[:self.batch_size]
+                    del self._rows[:len(rows)]
+                    await self._write(rows)
+            except _TRANSIENT_DB_ERRORS as e:
+                logger.error(f"Failed to flush push logs, {len(self._rows)} rows stay buffered: {e}")
+            return self.flushed - flushed
+
+    async def _write(self, rows: list):
+        """
+        写入一批，连接类错误把没写入的行放回缓冲区头部（保持顺序）后抛出
+        """
+        try:
+            await self._insert(rows)
+            self.flushed += len(rows)
+            return
+        except (*_TRANSIENT_DB_ERRORS, asyncio.CancelledError):
+            self._rows[:0] = rows
+            raise
+        except Exception as e:
+            logger.error(f"Failed to write {len(rows)} push logs, retrying row by row: {e}")
+        for i, row in enumerate(rows):
+            try:
+                await self._insert([row])
+            except (*_TRANSIENT_DB_ERRORS, asyncio.CancelledError):
+                self._rows[:0] = rows[i:]
+                raise
+            except Exception as e:
+                self.dropped += 1
+                logger.error(f"Dropped push log {row.get('push_id')}: {e}")
+                continue
+            self.flushed += 1
+
+    @staticmethod
+    async def _insert(rows: list):
+        async with SessionLocal() as session:
+            async with session.begin():
+                await session.execute(insert_ignore(PushLog), rows)
+
+    async def close(self):
+        """
+        停止时写入剩余记录，写不进去的暂存到 redis
+        """
+        await self.flush()
+        if not self._rows:
+            return
+        try:
+            await redis_client.rpush(PUSHLOG_BACKLOG_KEY, *[
+                json.dumps({**row, "push_at": row["push_at"].isoformat()}) for row in self._rows])
+            logger.warning(f"Saved {len(self._rows)} unflushed push logs to {PUSHLOG_BACKLOG_KEY}")
+            self._rows.clear()
+        except Exception as e:
+            logger.error(f"Failed to save {len(self._rows)} unflushed push logs: {e}")
+
+    async def restore(self):
+        """
+        载入上次停止时没写入的记录
+        """
+        while True:
+            items = await redis_client.lpop(PUSHLOG_BACKLOG_KEY, self.batch_size)
+            if not items:
+                return
+            for item in items:
+                row = json.loads(item)
+                row["push_at"] = datetime.fromisoformat(row["push_at"])
+                self._rows.append(truncate_columns(PushLog, row))
+
+    def snapshot(self) -> dict:
+        return {"buffered": len(self._rows), "flushed": self.flushed, "dropped": self.dropped}
+
+
+pushLogBuffer = PushLogBuffer()
+Gauge("push_log_buffered", "Push log rows waiting to be written", lambda: len(pushLogBuffer))
+
 
 async def logPushTask(taskId: str, data: dict):
     """
-    记录推送任务
+    记录推送任务，写入 pushLogBuffer 后批量落库
     :param taskId: str
     :param data: dict
     :return: Boolean
     :example: {'data': {'baseURL': 'https://api.day.app/uKeSrwm3ainGgn5SAmRyg9/', 'msg': 'You have a new notification!', 'push_receiver': 'yuki', 'icon': 'https://static.olelive.com/snap/fa77502e442ee6bbd39be20b2a2810ee.jpg?_n=202409290554', 'click_url': 'https://example.com', 'is_passive': False, 'headers': {'Authorization': 'Bearer your_token_here', 'Content-Type': 'application/json'}, 'log_data': {'push_id': '12345', 'push_receiver': 'user@example.com', 'push_by': 'system'}}, 'result': 'success'}
     """
-    async with SessionLocal() as session:
-        async with session.begin():
-            push_result = True if data['result'] == 'success' else False
-            pushLog = PushLog(
-                push_id=taskId,
-                push_receiver=data['data']['log_data']['push_receiver'],
-                push_channel="bark",
-                push_at=datetime.now(),
-                push_by=data['data']['log_data']['push_by'] if 'push_by' in data['data']['log_data'] else 'system',
-                push_result=push_result,
-                push_message=data['data']['msg'],
-                push_server='bark',
-                user_id=data['data']['log_data']['user_id'] if 'user_id' in data['data']['log_data'] else None
-            )
-            session.add(pushLog)
+    pushLogBuffer.add(_pushLogRow(taskId, data))
+    return True
+
+
+@repeat_every(seconds=PUSHLOG_FLUSH_SECONDS, wait_first=True)
+async def flushPushLogs():
+    """
+    定时写入缓冲的推送日志
+    """
+    await pushLogBuffer.flush()
+
+
+def _pushURL(data: dict) -> str:
+    return (
+        f"{data['baseURL']}{data['msg']}?"
+        f"icon={data['icon']}&"
+        f"url={data['click_url']}&"
+        f"passive={data['is_passive']}"
+    )
+
+
+async def _ensurePushGroup():
+    try:
+        await redis_client.xgroup_create(PUSH_STREAM, PUSH_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        # BUSYGROUP: 消费者组已存在
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def _processPushEntry(entry_id, fields: dict) -> bool:
+    """
+    投递一条推送任务，成功后确认并从 stream 删除；推送服务拒绝（4xx）直接进入死信队列；
+    其他失败不确认，闲置超时后会被重新认领
+    :return: 是否成功
+    """
+    if not fields:
+        await redis_client.xack(PUSH_STREAM, PUSH_GROUP, entry_id)
+        return False
+    taskID = fields[b"task_id"].decode()
+    data = json.loads(fields[b"payload"])
+    logger.info(f"Processing push task: {data}")
+    try:
+        result = await pushEngine.deliver(_pushURL(data))
+    except Exception as e:
+        logger.error(f"Failed to push task {taskID}: {e}")
+        result = "failed"
+    if result == "rejected":
+        await _deadLetter(entry_id, fields)
+        return False
+    data['result'] = 'success' if result == "success" else 'failed'
+    if result == "success":
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.xack(PUSH_STREAM, PUSH_GROUP, entry_id)
+            pipe.xdel(PUSH_STREAM, entry_id)
+            await pipe.execute()
+        logger.info(f"Push task successful: {data}")
+    else:
+        # 失败的任务会被重试，只在成功或进入死信队列时记录日志（push_id 唯一）
+        logger.error(f"Failed to push task: {data}")
+        return False
+    await _logPushResult(taskID, data)
+    return True
+
+
+async def _deadLetter(entry_id, fields: Optional[dict]):
+    """
+    把任务转入死信 stream 并记录失败日志
+    """
+    async with redis_client.pipeline(transaction=True) as pipe:
+        if fields:
+            pipe.xadd(PUSH_DEAD_STREAM, fields, maxlen=PUSH_STREAM_MAXLEN, approximate=True)
+        pipe.xack(PUSH_STREAM, PUSH_GROUP, entry_id)
+        pipe.xdel(PUSH_STREAM, entry_id)
+        await pipe.execute()
+    logger.error(f"Push task {entry_id} moved to {PUSH_DEAD_STREAM}")
+    if fields:
+        data = json.loads(fields[b"payload"])
+        data['result'] = 'failed'
+        await _logPushResult(fields[b"task_id"].decode(), data)
+
+
+async def _logPushResult(taskID: str, data: dict):
+    try:
+        await logPushTask(taskID, data)
+    except Exception as e:
+        logger.error(f"Failed to log push task: {e}", exc_info=True)
+
+
+async def _reclaimPushEntries() -> list:
+    """
+    认领闲置超时（投递失败或消费者崩溃）的任务，超过最大投递次数的转入死信队列
+    :return: 认领到的 [(entry_id, fields)]
+    """
+    pending = await redis_client.xpending_range(PUSH_STREAM, PUSH_GROUP, min="-", max="+",
+                                                count=PUSH_BATCH_SIZE, idle=PUSH_RETRY_IDLE_MS)
+    if not pending:
+        return []
+    retry, dead = [], []
+    for p in pending:
+        (dead if p["times_delivered"] >= PUSH_MAX_DELIVERIES else retry).append(p["message_id"])
+    for entry_id in dead:
+        entries = await redis_client.xrange(PUSH_STREAM, min=entry_id, max=entry_id)
+        await _deadLetter(entry_id, entries[0][1] if entries else None)
+    if not retry:
+        return []
+    claimed = await redis_client.xclaim(PUSH_STREAM, PUSH_GROUP, PUSH_CONSUMER, min_idle_time=PUSH_RETRY_IDLE_MS,
+                                        message_ids=retry)
+    entries = [(entry_id, fields) for entry_id, fields in claimed if entry_id and fields]
+    # 已经 XDEL 的条目认领后没有内容（旧版本 redis 整条返回 nil），确认掉，否则每次都会被重新认领
+    returned = {entry_id for entry_id, _ in entries}
+    for entry_id in retry:
+        if entry_id not in returned and not await redis_client.xrange(PUSH_STREAM, min=entry_id, max=entry_id):
+            await redis_client.xack(PUSH_STREAM, PUSH_GROUP, entry_id)
+    return entries
+
+
+async def migrateLegacyPushTasks():
+    """
+    把旧版本写入的 pushTask:* key 迁移到 stream，只需要一个 worker 执行
+    """
+    if not await redis_client.set("lock:pushTaskMigrate", PUSH_CONSUMER, nx=True, ex=60):
+        return 0
+    keys = await get_keys_by_pattern('pushTask:*')
+    for key in keys:
+        value = await get_key(key)
+        if value:
+            await redis_client.xadd(PUSH_STREAM, {"task_id": key.split(":")[1], "payload": value},
+                                    maxlen=PUSH_STREAM_MAXLEN, approximate=True)
+        await delete_key(key)
+    if keys:
+        logger.info(f"Migrated {len(keys)} legacy push tasks to {PUSH_STREAM}")
+    return len(keys)
+
+
+async def pushTaskExecQueue():
+    """
+    以消费者组方式消费推送任务 stream：
+    - XREADGROUP 阻塞读取新任务，写入后几乎立即投递；同一任务只会投递给一个 worker
+    - 任务交给 pushEngine 并发投递，只读取空闲并发槽位数量的任务；等待繁忙 host 或退避中的任务不计入，
+      一个 host 的积压不会挡住其他 host 的任务，已读取未完成的任务总数不超过 PUSH_MAX_BUFFERED
+    - 定期认领闲置超时的未确认任务重新投递，超过 PUSH_MAX_DELIVERIES 次进入死信 stream
+    """
+    lastReclaim = lastTouch = 0.0
+    inflight = {}
+    try:
+        while True:
             try:
-                await session.commit()
-                return True
-            except OperationalError as e:
-                async with session.begin():
-                    session.rollback()
-                    pushLog = PushLog(
-                        push_id=taskId,
-                        push_receiver=data['data']['log_data']['push_receiver'],
-                        push_channel="bark",
-                        push_at=datetime.now(),
-                        push_by=data['data']['log_data']['push_by'] if 'push_by' in data['data'][
-                            'log_data'] else 'system',
-                        push_result=push_result,
-                        push_message=data['data']['msg'],
-                        push_server='bark',
-                        user_id=data['data']['log_data']['user_id'] if 'user_id' in data['data']['log_data'] else None
-                    )
-                    session.add(pushLog)
-                    await session.commit()
-                    return True
+                await _ensurePushGroup()
+                while True:
+                    capacity = min(pushEngine.concurrency - (len(inflight) - pushEngine.parked),
+                                   PUSH_MAX_BUFFERED - len(inflight))
+                    if capacity <= 0:
+                        # 等到有任务完成，或者有任务开始等待繁忙 host / 退避而让出配额
+                        pushEngine.released.clear()
+                        released = asyncio.get_running_loop().create_task(pushEngine.released.wait())
+                        await asyncio.wait([*inflight, released], timeout=PUSH_RETRY_IDLE_MS / 3000,
+                                           return_when=asyncio.FIRST_COMPLETED)
+                        released.cancel()
+                    if inflight and time.monotonic() - lastTouch >= PUSH_RETRY_IDLE_MS / 3000:
+                        # 重置正在投递的任务的闲置时间，避免投递较慢时被其他 worker 重复认领
+                        lastTouch = time.monotonic()
+                        await redis_client.xclaim(PUSH_STREAM, PUSH_GROUP, PUSH_CONSUMER, min_idle_time=0,
+                                                  message_ids=list(inflight.values()), justid=True)
+                    if capacity <= 0:
+                        continue
+                    entries = []
+                    if time.monotonic() - lastReclaim >= PUSH_RETRY_IDLE_MS / 1000:
+                        lastReclaim = time.monotonic()
+                        entries = await _reclaimPushEntries()
+                    if not entries:
+                        started = time.monotonic()
+                        result = await redis_client.xreadgroup(PUSH_GROUP, PUSH_CONSUMER, {PUSH_STREAM: ">"},
+                                                               count=min(capacity, PUSH_BATCH_SIZE),
+                                                               block=PUSH_BLOCK_MS)
+                        entries = result[0][1] if result else []
+                        remaining = PUSH_BLOCK_MS / 1000 - (time.monotonic() - started)
+                        if not entries and remaining > 0:
+                            # 不支持阻塞读取的 redis 兼容实现会立即返回，避免空转
+                            await asyncio.sleep(remaining)
+                    if entries:
+                        logger.info(f"Found {len(entries)} push tasks in the queue.")
+                    for entry_id, fields in entries:
+                        if entry_id in inflight.values():
+                            continue
+                        task = asyncio.get_running_loop().create_task(_processPushEntry(entry_id, fields))
+                        inflight[task] = entry_id
+                        task.add_done_callback(lambda t: inflight.pop(t, None))
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"Failed to log push task: {e}", exc_info=True)
-                return False
+                logger.error(f"Error in pushTaskExecQueue: {e}", exc_info=True)
+                await asyncio.sleep(1)
+    finally:
+        # 停止时取消正在投递的任务，未确认的任务会被重新认领
+        for task in inflight:
+            task.cancel()
 
 
-@repeat_every(seconds=30, wait_first=True)  # wait_first=True 表示等待第一次执行 也就是启动时执行
-async def pushTaskExecQueue() -> bool:
+async def pushQueueStats() -> dict:
     """
-    Process push tasks from the Redis keys matching 'pushTask:*' pattern.
-    :return: Boolean indicating success.
+    推送队列深度和投递引擎的统计
+    :return: dict
     """
+    stats = pushEngine.snapshot()
+    stats["log_buffer"] = pushLogBuffer.snapshot()
     try:
-        all_keys = await get_keys_by_pattern('pushTask:*')
-        if not all_keys:
-            return False
-        logger.info(f"Found {len(all_keys)} push tasks in the queue.")
-
-        async with AsyncClient() as client:
-            for key in all_keys:
-                value = await get_key(key)
-                if not value:
-                    continue
-
-                data = json.loads(value)
-                logger.info(f"Processing push task: {data}")
-                url = (
-                    f"{data['baseURL']}{data['msg']}?"
-                    f"icon={data['icon']}&"
-                    f"url={data['click_url']}&"
-                    f"passive={data['is_passive']}"
-                )
-                url.replace("//", "/").replace("https:/", "https://")
-                response = await client.post(url)
-                if response.status_code == 200:
-                    await delete_key(key)
-                    data['result'] = 'success'
-                    logger.info(f"Push task successful: {data}")
-                else:
-                    data['result'] = 'failed'
-                    logger.error(f"Failed to push task: {data}")
-
-                try:
-                    # taskID 取 pushTask: 后面的字符串
-                    taskID = key.split(":")[1]
-                    print(taskID)
-                    await logPushTask(taskID, data)
-                except Exception as e:
-                    logger.error(f"Failed to log push task: {e}", exc_info=True)
-
-        return True
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.xlen(PUSH_STREAM)
+            pipe.xlen(PUSH_DEAD_STREAM)
+            pipe.xpending(PUSH_STREAM, PUSH_GROUP)
+            length, dead, pending = await pipe.execute(raise_on_error=False)
+        # 已确认的任务会被删除，stream 长度 = 未读取 + 未确认
+        stats["queue_length"] = length if isinstance(length, int) else None
+        stats["dead_letters"] = dead if isinstance(dead, int) else None
+        stats["pending"] = pending["pending"] if isinstance(pending, dict) else None
+    except Exception as e:
+        logger.error(f"Failed to get push queue stats: {e}")
+    return stats
+
+
+async def _pushQueueMetrics() -> list:
+    stats = await pushQueueStats()
+    return [(f"push_{key}", f"Push stream {key.replace('_', ' ')}", stats[key])
+            for key in ("queue_length", "dead_letters", "pending") if stats.get(key) is not None]
+
 
+register_async_collector(_pushQueueMetrics)
+
+
+async def startPushConsumer():
+    """
+    启动推送消费者，在 lifespan 中调用
+    """
+    global _pushConsumer
+    try:
+        await migrateLegacyPushTasks()
     except Exception as e:
-        logger.error(f"Error in pushTaskExecQueue: {e}", exc_info=True)
-        return False
+        logger.error(f"Failed to migrate legacy push tasks: {e}")
+    if _pushConsumer is None or _pushConsumer.done():
+        _pushConsumer = asyncio.get_running_loop().create_task(pushTaskExecQueue())
+
+
+async def stopPushConsumer():
+    """
+    停止推送消费者，未确认的任务会被其他 worker 认领
+    """
+    global _pushConsumer
+    if _pushConsumer is not None:
+        _pushConsumer.cancel()
+        try:
+            await _pushConsumer
+        except (asyncio.CancelledError, Exception):
+            pass
+        _pushConsumer = None
 
 
 @repeat_every(seconds=3 * 60, wait_first=True)
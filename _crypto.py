@@ -1,55 +1,247 @@
+import asyncio
 import base64
+import hashlib
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from logging import getLogger
 
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives import serialization
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from fastapi import Depends, Request, Response
 from fastapi.routing import APIRouter
 from fastapi_limiter.depends import RateLimiter
+from fastapi_utils.tasks import repeat_every
+from starlette.responses import JSONResponse
 
-from _redis import delete_key as redis_delete_key, get_key as redis_get_key, set_key as redis_set_key
+import _cryptoworker
+from _cryptoworker import rsa_decrypt as _rsa_decrypt
+from _metrics import decrypt_errors
+from _redis import get_key as redis_get_key, redis_client, \
+    set_key as redis_set_key
+from _singleflight import _RELEASE_SCRIPT
 
 logger = getLogger(__name__)
 
 cryptoRouter = APIRouter(prefix='/api/crypto', tags=['Crypto', 'Crypto Api'])
 
+KEYRING_REFRESH_SECONDS = int(os.getenv("KEYRING_REFRESH_SECONDS", 30))
+CRYPTO_EXECUTOR = os.getenv("CRYPTO_EXECUTOR", "thread").lower()  # thread | process | inline
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", 2))
+CRYPTO_MAX_PENDING = int(os.getenv("CRYPTO_MAX_PENDING", 64))  # 排队中的解密任务上限，超过直接返回 503
+CRYPTO_SESSION_TTL = int(os.getenv("CRYPTO_SESSION_TTL", 60 * 60))  # 会话密钥有效期（秒）
+CRYPTO_INIT_LOCK = "lock:crypto:init"
+CRYPTO_INIT_WAIT = 10  # 等待其他 worker 生成密钥的最长时间（秒）
+DECRYPT_ERROR_LOG_INTERVAL = 60  # 解密失败日志的最短间隔（秒）
+
+_lastDecryptErrorLog = 0.0
+
+
+class KeyRing:
+    """
+    进程内持有解析好的 RSA 私钥和公钥 PEM，避免每次请求都从 redis 读取并解析 PEM
+    redis 中的 crypto_key_version 变化时重新加载，轮换密钥不需要重启 worker
+    """
+
+    def __init__(self):
+        self.private_key = None
+        self.private_pem = None
+        self.public_pem = None
+        self.version = None
+
+    async def load(self) -> bool:
+        """
+        从 redis 加载密钥
+        :return: bool
+        """
+        private_pem = await redis_get_key("private_key")
+        public_pem = await redis_get_key("public_key")
+        if not private_pem or not public_pem:
+            return False
+        version = await redis_get_key("crypto_key_version") or _pem_version(public_pem)
+        self.private_key = serialization.load_pem_private_key(private_pem.encode(), password=None)
+        self.private_pem = private_pem
+        self.public_pem = public_pem
+        self.version = version
+        logger.info(f"Keyring loaded, version: {version}")
+        return True
+
+    async def refresh(self) -> bool:
+        """
+        版本变化时重新加载
+        :return: 是否重新加载
+        """
+        version = await redis_get_key("crypto_key_version")
+        if self.private_key is not None and (version is None or version == self.version):
+            return False
+        return await self.load()
+
+    async def get_private_key(self):
+        if self.private_key is None and not await self.load():
+            raise Exception("Internal Server Error")
+        return self.private_key
+
+    async def get_public_pem(self) -> str:
+        if self.public_pem is None:
+            await self.load()
+        return self.public_pem
+
+
+def _pem_version(public_pem: str) -> str:
+    """
+    没有显式版本号的旧密钥，用公钥指纹作为版本
+    """
+    return hashlib.sha256(public_pem.encode()).hexdigest()[:16]
+
+
+keyRing = KeyRing()
+
+
+class CryptoBusy(Exception):
+    """
+    解密队列已满
+    """
+
+
+class DecryptPool:
+    """
+    把 RSA-OAEP 解密放到线程池或进程池执行，不阻塞事件循环
+    - thread：共享进程内已解析的私钥
+    - process：子进程启动时解析私钥，密钥版本变化时重建进程池
+    - inline：在事件循环中直接解密（旧行为）
+    排队任务数达到 max_pending 时直接拒绝，避免请求无限堆积
+    """
+
+    def __init__(self, mode: str = CRYPTO_EXECUTOR, workers: int = CRYPTO_WORKERS,
+                 max_pending: int = CRYPTO_MAX_PENDING):
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+        self._version = None
+
+    def _get_executor(self):
+        if self.mode == "process":
+            if self._executor is None or self._version != keyRing.version:
+                old = self._executor
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=_cryptoworker.init_worker,
+                                                     initargs=(keyRing.private_pem,))
+                self._version = keyRing.version
+                if old is not None:
+                    old.shutdown(wait=False)
+        elif self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="decrypt")
+        return self._executor
+
+    async def decrypt(self, private_key, encrypted_data: bytes) -> bytes:
+        """
+        解密
+        :param private_key: 已解析的私钥（process 模式下不使用）
+        :param encrypted_data: 密文
+        :return: 明文
+        :raises CryptoBusy: 队列已满
+        """
+        if self.mode == "inline":
+            return _rsa_decrypt(private_key, encrypted_data)
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise CryptoBusy()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            if self.mode == "process":
+                return await loop.run_in_executor(self._get_executor(), _cryptoworker.decrypt, encrypted_data)
+            return await loop.run_in_executor(self._get_executor(), _rsa_decrypt, private_key, encrypted_data)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def snapshot(self) -> dict:
+        return {"mode": self.mode, "workers": self.workers, "pending": self.pending, "rejected": self.rejected}
+
+
+decryptPool = DecryptPool()
+
+
+@repeat_every(seconds=KEYRING_REFRESH_SECONDS, wait_first=True)
+async def refreshKeyRing():
+    """
+    定时检查密钥版本
+    """
+    try:
+        await keyRing.refresh()
+    except Exception as e:
+        logger.error(f"Failed to refresh keyring: {e}")
+    return True
+
+
+def _generate_key_pair() -> tuple:
+    """
+    生成一对 rsa 密钥
+    :return: (private_pem, public_pem)
+    """
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048
+    )
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return private_pem.decode(), public_pem.decode()
+
 
 async def init_crypto():
     """
     初始化加密模块
+    多个 worker 同时启动时只有拿到锁的 worker 生成密钥，其余等待它写入 redis
     :return:
     """
     try:
-        a = await redis_get_key("private_key")
-        b = await redis_get_key("public_key")
-        if a and b:
-            return True
-        else:
-            try:
-                await redis_delete_key("private_key")
-                await redis_delete_key("public_key")
-            except Exception as e:
-                pass
-            # 生成一对rsa密钥 并且保存到redis
-            private_key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048
-            )
-            public_key = private_key.public_key()
-            # 保存到redis
-            private_pem = private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            )
-            public_pem = public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-            await redis_set_key("private_key", private_pem.decode())
-            await redis_set_key("public_key", public_pem.decode())
-
-            return True
+        for _ in range(CRYPTO_INIT_WAIT * 10):
+            a = await redis_get_key("private_key")
+            b = await redis_get_key("public_key")
+            if a and b:
+                if not await redis_get_key("crypto_key_version"):
+                    await redis_set_key("crypto_key_version", _pem_version(b))
+                await keyRing.load()
+                return True
+            token = uuid.uuid4().hex
+            if await redis_client.set(CRYPTO_INIT_LOCK, token, nx=True, ex=CRYPTO_INIT_WAIT):
+                try:
+                    # 拿到锁之前可能有其他 worker 刚写完密钥并释放了锁，重新检查，不覆盖已有的密钥
+                    if await redis_get_key("private_key") and await redis_get_key("public_key"):
+                        continue
+                    # 生成密钥是 CPU 密集操作，放到线程里，不阻塞同一事件循环上的其他启动步骤
+                    private_pem, public_pem = await asyncio.to_thread(_generate_key_pair)
+                    async with redis_client.pipeline(transaction=True) as pipe:
+                        pipe.set("private_key", private_pem)
+                        pipe.set("public_key", public_pem)
+                        pipe.set("crypto_key_version", uuid.uuid4().hex[:16])
+                        await pipe.execute()
+                    await keyRing.load()
+                    return True
+                finally:
+                    # 只释放自己的锁（生成超过锁的过期时间时，锁可能已经属于其他 worker）
+                    await redis_client.eval(_RELEASE_SCRIPT, 1, CRYPTO_INIT_LOCK, token)
+            await asyncio.sleep(0.1)
+        raise TimeoutError("timed out waiting for another worker to generate the key pair")
     except Exception as e:
         raise Exception(f"Failed to init crypto: {e}")
 
@@ -62,8 +254,22 @@ async def get_public_key(request: Request):
     :param request:
     :return:
     """
-    public_key = await redis_get_key("public_key")
-    return Response(content=public_key, media_type="text/plain")
+    public_key = await keyRing.get_public_pem()
+    return Response(content=public_key, media_type="text/plain",
+                    headers={"X-Key-Version": keyRing.version or ""})
+
+
+def _decryptFailed(kind: str):
+    """
+    记录一次解密失败；密文来自客户端，只计数，不在日志中输出异常内容，日志按间隔限流
+    :param kind: rsa | session | utf8
+    """
+    global _lastDecryptErrorLog
+    decrypt_errors.inc(kind)
+    now = time.monotonic()
+    if now - _lastDecryptErrorLog >= DECRYPT_ERROR_LOG_INTERVAL:
+        _lastDecryptErrorLog = now
+        logger.warning(f"Decryption failed ({kind}), see decrypt_errors_total for the count")
 
 
 async def decryptData(data: str):
@@ -72,39 +278,90 @@ async def decryptData(data: str):
     :param data: str
     :return:
     """
+    decrypted_data = await decryptBytes(data)
     try:
-        private_key = await redis_get_key("private_key")
+        return decrypted_data.decode('utf-8')
+    except Exception:
+        _decryptFailed("utf8")
+        raise Exception("Unexpected error")
+
+
+async def decryptBytes(data: str) -> bytes:
+    """
+    RSA-OAEP 解密
+    :param data: base64 编码的密文
+    :return: bytes
+    """
+    try:
+        private_key = await keyRing.get_private_key()
     except Exception as e:
         raise Exception(f"redis error")
     try:
-        private_key_data = await redis_get_key("private_key")
-
-        # 检查是否正确获取了私钥
-        if not private_key_data:
-            raise Exception("Internal Server Error")
-
-        private_key = serialization.load_pem_private_key(
-            private_key_data.encode(),
-            password=None
-        )
-
         # 使用 Base64 解码
         encrypted_data = base64.b64decode(data)
 
-        # 解密数据
-        decrypted_data = private_key.decrypt(
-            encrypted_data,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA1()),
-                algorithm=hashes.SHA1(),
-                label=None
-            )
-        )
+        try:
+            return await decryptPool.decrypt(private_key, encrypted_data)
+        except ValueError:
+            # 可能刚好发生了密钥轮换，刷新后重试一次
+            if not await keyRing.refresh():
+                raise
+            return await decryptPool.decrypt(keyRing.private_key, encrypted_data)
 
-        # print("decrypted_data", decrypted_data.decode('utf-8'))
+    except CryptoBusy:
+        raise
+    except Exception:
+        _decryptFailed("rsa")
+        raise Exception("Unexpected error")
+
+
+class SessionExpired(Exception):
+    """
+    会话不存在或已过期，客户端需要重新握手
+    """
 
-        return decrypted_data.decode('utf-8')
 
+@cryptoRouter.api_route('/handshake', dependencies=[Depends(RateLimiter(times=2, seconds=1))],
+                        methods=['POST'], summary='Handshake', description='Exchange a session key')
+async def handshake(request: Request):
+    """
+    会话密钥握手：客户端用公钥 RSA-OAEP 加密一个 AES 密钥（16/24/32 字节）发过来，只需要一次 RSA 运算
+    之后的请求带上 session，data 使用 AES-GCM 加密：base64(12 字节 nonce + 密文)，附加数据为 timestamp
+    请求：{"key": base64(RSA-OAEP(aes_key))}
+    返回：{"session": str, "expires_in": int}
+    """
+    try:
+        data = await request.json()
+        key = await decryptBytes(data.get('key'))
+    except CryptoBusy:
+        return JSONResponse({"error": "Server Busy"}, status_code=503, headers={"Retry-After": "1"})
     except Exception as e:
-        print(f"Decryption error: {e}")
+        return JSONResponse({"error": "Invalid Request, invalid key"}, status_code=400)
+    if len(key) not in (16, 24, 32):
+        return JSONResponse({"error": "Invalid Request, invalid key length"}, status_code=400)
+    session = uuid.uuid4().hex
+    # 存在 redis 中所有 worker 共享，同时会进入 L1 缓存
+    if not await redis_set_key(f"crypto_session:{session}", base64.b64encode(key).decode(), ex=CRYPTO_SESSION_TTL):
+        return JSONResponse({"error": "Internal Server Error"}, status_code=500)
+    return JSONResponse({"session": session, "expires_in": CRYPTO_SESSION_TTL}, status_code=200)
+
+
+async def decryptSessionData(session: str, data: str, timestamp) -> str:
+    """
+    使用会话密钥 AES-GCM 解密
+    :param session: 握手得到的 session
+    :param data: base64(nonce + 密文)
+    :param timestamp: 请求中的 timestamp，作为附加数据防止被篡改
+    :return: str
+    :raises SessionExpired: 会话不存在或已过期
+    """
+    key = await redis_get_key(f"crypto_session:{session}")
+    if not key:
+        raise SessionExpired()
+    try:
+        raw = base64.b64decode(data)
+        decrypted_data = AESGCM(base64.b64decode(key)).decrypt(raw[:12], raw[12:], str(timestamp).encode())
+        return decrypted_data.decode('utf-8')
+    except (InvalidTag, ValueError):
+        _decryptFailed("session")
         raise Exception("Unexpected error")
@@ -0,0 +1,31 @@
+"""
+解密进程池的子进程入口，只依赖 cryptography，避免子进程导入整个应用
+"""
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+_private_key = None
+
+
+def rsa_decrypt(private_key, encrypted_data: bytes) -> bytes:
+    return private_key.decrypt(
+        encrypted_data,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA1()),
+            algorithm=hashes.SHA1(),
+            label=None
+        )
+    )
+
+
+def init_worker(private_pem: str):
+    """
+    子进程启动时解析一次私钥
+    :param private_pem: PEM 格式的私钥
+    """
+    global _private_key
+    _private_key = serialization.load_pem_private_key(private_pem.encode(), password=None)
+
+
+def decrypt(encrypted_data: bytes) -> bytes:
+    return rsa_decrypt(_private_key, encrypted_data)
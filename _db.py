@@ -1,16 +1,26 @@
+import asyncio
 import datetime
+import hashlib
+import json
 import logging
 import os
+import time
 from enum import Enum as PyEnum
+from typing import Optional
 from uuid import uuid4
 
 import dotenv
-import sqlalchemy
-from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Integer, String, Text, select, text
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Integer, String, Text, event, insert, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from _metrics import Gauge, mysql_pool_checkout, mysql_query_duration
+from _redis import redis_client
 
 dotenv.load_dotenv()
 logger = logging.getLogger(__name__)
@@ -22,11 +32,51 @@ if not DATABASE_URL:
 if DATABASE_URL.startswith("mysql://"):
     DATABASE_URL = DATABASE_URL.replace("mysql://", "mysql+asyncmy://", 1)
 # === DATABASE ===
+VOD_CACHE_RETRIES = int(os.getenv("VOD_CACHE_RETRIES", 3))  # vod_info 写入遇到 OperationalError 的最大尝试次数
+VOD_HASH_KEY = "vod_info:hash:"  # + vod_id -> 最后写入内容的哈希，每个 id 单独过期
+VOD_HASH_TTL = int(os.getenv("VOD_HASH_TTL", 60 * 60 * 24))
+VOD_WRITE_INTERVAL = float(os.getenv("VOD_WRITE_INTERVAL", 5))  # vod_info 写缓冲的写入间隔（秒）
+VOD_WRITE_BATCH_SIZE = int(os.getenv("VOD_WRITE_BATCH_SIZE", 500))
+VOD_WRITE_MAX_PENDING = int(os.getenv("VOD_WRITE_MAX_PENDING", 20000))
 
 # Set up SQLAlchemy
 Base = declarative_base()  # 这里是一个基类，所有的 ORM 类都要继承这个类
-engine = create_async_engine(DATABASE_URL, pool_size=20, max_overflow=0, pool_recycle=600,
-                             pool_pre_ping=True)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    记录从连接池取连接的等待时间（连接池耗尽时请求会在这里排队）
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            mysql_pool_checkout.observe(time.perf_counter() - start)
+
+
+_engine_options = {"pool_recycle": 600, "pool_pre_ping": True}
+if not DATABASE_URL.startswith("sqlite"):
+    # SQLite（测试环境）使用 SQLAlchemy 默认的连接池，不支持这些参数
+    _engine_options.update(pool_size=20, max_overflow=0, poolclass=TimedQueuePool)
+engine = create_async_engine(DATABASE_URL, **_engine_options)
+
+
+# 开始时间记在每条语句自己的执行上下文上，执行失败的语句不会影响同一连接上后续语句的计时
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if start is not None:
+        mysql_query_duration.observe(time.perf_counter() - start, statement.lstrip().split(" ", 1)[0].upper())
+
+
 # noinspection PyTypeChecker
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
 
@@ -181,6 +231,14 @@ async def init_db():
             raise RuntimeError(f"Database initialization failed: {str(e)}")
 
 
+def insert_ignore(table):
+    """
+    忽略唯一键冲突的 INSERT（MySQL: INSERT IGNORE，SQLite: INSERT OR IGNORE）
+    :param table: ORM 类
+    """
+    return insert(table).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+
+
 async def test_db_connection():
     try:
         async with SessionLocal() as session:
@@ -193,62 +251,252 @@ async def test_db_connection():
         raise ConnectionError(f"Database connection failed: {str(e)}")
 
 
-async def cache_vod_data(data):
+def _vod_row(item: dict) -> dict:
+    """
+    上游搜索结果的一条转成 vod_info 的一行，字符串按列长度截断
+    """
+    episodes = item.get("episodes", 0)
+    row = {
+        "vod_id": str(item["id"]),
+        "vod_name": item["name"],
+        "vod_typeId": item["typeId"],
+        "vod_typeId1": item["typeId1"],
+        "vod_remarks": item["remarks"],
+        "vod_is_vip": item["vip"],
+        "vod_episodes": len(episodes) if isinstance(episodes, list) else episodes,
+        "vod_urls": item.get("pic", ""),
+        "vod_new": item.get("new", False),
+        "vod_version": item.get("version", "未知"),
+        "vod_score": item.get("score", 0.0),
+        "vod_year": item.get("year", 0),
+    }
+    return truncate_columns(VodInfo, row)
+
+
+def truncate_columns(table, row: dict) -> dict:
+    """
+    字符串按列长度截断，MySQL 严格模式下超长的值会让整条 INSERT 失败
+    :param table: ORM 类
+    :param row: 一行数据，原地修改
+    :return: row
+    """
+    for column in table.__table__.columns:
+        value = row.get(column.name)
+        if isinstance(value, str) and getattr(column.type, "length", None):
+            row[column.name] = value[:column.type.length]
+    return row
+
+
+def _vod_hash(row: dict) -> str:
+    return hashlib.sha1(json.dumps(row, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+def _upsert_vod_info(rows: list):
     """
+    一条多行 INSERT ... ON DUPLICATE KEY UPDATE（SQLite: ON CONFLICT DO UPDATE）
+    """
+    columns = [c for c in rows[0] if c != "vod_id"]
+    if engine.dialect.name == "sqlite":
+        stmt = sqlite_insert(VodInfo).values(rows)
+        return stmt.on_conflict_do_update(index_elements=["vod_id"],
+                                          set_={c: stmt.excluded[c] for c in columns})
+    stmt = mysql_insert(VodInfo).values(rows)
+    return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in columns})
+
 
-    :param data:
+def vod_rows(data) -> dict:
+    """
+    上游搜索响应中的 vod 条目
+    :return: {vod_id: row}
+    """
+    rows = {}
+    for vod_data in data["data"]["data"]:
+        if vod_data["type"] == "vod":
+            for item in vod_data["list"]:
+                row = _vod_row(item)
+                rows[row["vod_id"]] = row
+    return rows
+
+
+async def upsert_vod_rows(rows: dict) -> int:
+    """
+    一条 upsert 写入 vod_info，内容没有变化的行（按内容哈希判断）不写
+    :param rows: {vod_id: row}
+    :return: 写入的行数
+    :raise OperationalError: 重试 VOD_CACHE_RETRIES 次后仍然失败
+    """
+    if not rows:
+        return 0
+    ids = list(rows)
+    hashes = {vod_id: _vod_hash(row) for vod_id, row in rows.items()}
+    try:
+        known = await redis_client.mget([VOD_HASH_KEY + vod_id for vod_id in ids])
+        changed = [vod_id for vod_id, h in zip(ids, known) if h is None or h.decode() != hashes[vod_id]]
+    except Exception as e:
+        logger.error("Failed to read vod content hashes: %s", str(e))
+        changed = ids
+    if not changed:
+        return 0
+    for attempt in range(VOD_CACHE_RETRIES):
+        try:
+            async with SessionLocal() as session:
+                async with session.begin():
+                    # 分块，避免超过单条语句的占位符数量上限
+                    for i in range(0, len(changed), VOD_WRITE_BATCH_SIZE):
+                        chunk = changed[i:i + VOD_WRITE_BATCH_SIZE]
+                        await session.execute(_upsert_vod_info([rows[vod_id] for vod_id in chunk]))
+            break
+        except OperationalError:
+            if attempt == VOD_CACHE_RETRIES - 1:
+                raise
+            await asyncio.sleep(0.1 * 2 ** attempt)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for vod_id in changed:
+                pipe.set(VOD_HASH_KEY + vod_id, hashes[vod_id], ex=VOD_HASH_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.error("Failed to save vod content hashes: %s", str(e))
+    return len(changed)
+
+
+async def cache_vod_data(data):
+    """
+    把搜索结果直接写入 vod_info（请求路径上用 vodWriter.add，由后台统一写入）
+    :param data: 上游搜索接口的响应
+    :return: 写入的行数
     """
     try:
-        db: SessionLocal = SessionLocal()
-        for vod_data in data["data"]["data"]:
-            if vod_data["type"] == "vod":
-                for item in vod_data["list"]:
-                    # 查找是否存在相同的 vod_id
-                    # noinspection PyTypeChecker
-                    stmt = select(VodInfo).where(VodInfo.vod_id == str(item["id"]))
-                    result = await db.execute(stmt)
-                    db_vod = result.scalar_one_or_none()
-                    episode_list = item.get("episodes", [])
-                    if episode_list:
-                        item["episodes"] = len(episode_list)
-                    if db_vod:
-                        # 更新现有数据
-                        db_vod.vod_name = item["name"]
-                        db_vod.vod_typeId = item["typeId"]
-                        db_vod.vod_typeId1 = item["typeId1"]
-                        db_vod.vod_remarks = item["remarks"]
-                        db_vod.vod_is_vip = item["vip"]
-                        db_vod.vod_episodes = item.get("episodes", 0)
-                        db_vod.vod_urls = item.get("pic", "")
-                        db_vod.vod_new = item.get("new", False)
-                        db_vod.vod_version = item.get("version", "未知")
-                        db_vod.vod_score = item.get("score", 0.0)
-                        db_vod.vod_year = item.get("year", 0)
-                    else:
-                        # 插入新数据
-                        new_vod = VodInfo(
-                            vod_id=str(item["id"]),
-                            vod_name=item["name"],
-                            vod_typeId=item["typeId"],
-                            vod_typeId1=item["typeId1"],
-                            vod_remarks=item["remarks"],
-                            vod_is_vip=item["vip"],
-                            vod_episodes=item.get("episodes", 0),
-                            vod_urls=item.get("pic", ""),
-                            vod_new=item.get("new", False),
-                            vod_version=item.get("version", "未知"),
-                            vod_score=item.get("score", 0.0),
-                            vod_year=item.get("year", 0)
-                        )
-                        db.add(new_vod)
-
-                    await db.commit()
-        await db.close()
-    except sqlalchemy.exc.OperationalError:
-        # retry
-        await cache_vod_data(data)
+        return await upsert_vod_rows(vod_rows(data))
     except Exception as e:
         logger.error("Error while caching data: %s", str(e))
+        return 0
+
+
+class VodWriteBehind:
+    """
+    vod_info 写缓冲：各个请求的搜索结果按 vod_id 合并（后来的覆盖先到的），
+    由唯一的后台 writer 每隔 VOD_WRITE_INTERVAL 秒（或积压超过 VOD_WRITE_BATCH_SIZE 条时）分批 upsert，
+    无论搜索流量多大，每个 worker 同时只有一个 vod_info 写事务
+    """
+
+    def __init__(self, interval: float = VOD_WRITE_INTERVAL, batch_size: int = VOD_WRITE_BATCH_SIZE,
+                 max_pending: int = VOD_WRITE_MAX_PENDING):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending: dict = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.flushes = 0
+        self.written = 0
+        self.merged = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, data):
+        """
+        合并一页搜索结果，不等待写入
+        :param data: 上游搜索接口的响应
+        """
+        try:
+            rows = vod_rows(data)
+        except (KeyError, TypeError) as e:
+            logger.error("Error while caching data: %s", str(e))
+            return
+        self.add_rows(rows)
+
+    def add_rows(self, rows: dict):
+        """
+        合并已经转换好的行，不等待写入
+        :param rows: vod_rows 的结果
+        """
+        for vod_id, row in rows.items():
+            if vod_id in self._pending:
+                self.merged += 1
+            elif len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                continue
+            self._pending[vod_id] = row
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        """
+        写入当前积压的所有行，失败的行放回队列（不覆盖期间到达的新数据）
+        :return: 写入的行数
+        """
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        started = time.perf_counter()
+        written = 0
+        items = list(pending.items())
+        for i in range(0, len(items), self.batch_size):
+            batch = dict(items[i:i + self.batch_size])
+            try:
+                written += await upsert_vod_rows(batch)
+            except BaseException as e:
+                # 包括被取消：未写入的行放回队列，由下一次 flush 写入
+                for vod_id, row in items[i:]:
+                    self._pending.setdefault(vod_id, row)
+                if not isinstance(e, Exception):
+                    raise
+                logger.error("Failed to flush %d vod rows: %s", len(batch), str(e))
+                break
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 3)
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.flushes += 1
+        self.written += written
+        return written
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Error in vod writer: %s", str(e), exc_info=True)
+
+    def start(self):
+        """
+        启动后台 writer，在 lifespan 中调用
+        """
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """
+        停止后台 writer 并写入剩余的行；不取消 writer，正在进行的 flush 写完后 writer 自行退出
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            try:
+                await self._task
+            except Exception:
+                pass
+            self._task = None
+        await self.flush()
+
+    def snapshot(self) -> dict:
+        return {"pending": len(self._pending), "flushes": self.flushes, "written": self.written,
+                "merged": self.merged, "dropped": self.dropped, "last_flush_ms": self.last_flush_ms,
+                "max_flush_ms": self.max_flush_ms}
+
+
+vodWriter = VodWriteBehind()
+Gauge("vod_writer_pending", "vod_info rows waiting in the write-behind queue", lambda: len(vodWriter))
 
 
 class requestUpdate(Base):
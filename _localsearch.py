@@ -0,0 +1,266 @@
+import asyncio
+import bisect
+import heapq
+import logging
+import os
+import re
+import time
+import unicodedata
+
+from cachetools import LRUCache
+from fastapi_utils.tasks import repeat_every
+from sqlalchemy import select
+
+from _db import SessionLocal, VodInfo
+
+logger = logging.getLogger(__name__)
+
+LOCAL_SEARCH_REFRESH_SECONDS = int(os.getenv("LOCAL_SEARCH_REFRESH_SECONDS", 60))  # 增量载入新行的间隔
+LOCAL_SEARCH_REBUILD_SECONDS = int(os.getenv("LOCAL_SEARCH_REBUILD_SECONDS", 60 * 60))  # 全量重建的间隔
+AUTOCOMPLETE_MEMO_SIZE = int(os.getenv("AUTOCOMPLETE_MEMO_SIZE", 10000))  # 缓存补全结果的前缀数量
+
+_PUNCTUATION = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    """
+    统一全角/半角、大小写，去掉空白和标点
+    """
+    return _PUNCTUATION.sub("", unicodedata.normalize("NFKC", text or "").lower())
+
+
+def _grams(text: str) -> set:
+    """
+    单字 + 二元组；中文不分词，二元组足够区分大多数片名
+    """
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+def _item(row: dict) -> dict:
+    """
+    vod_info 的一行转回上游搜索结果中的条目
+    """
+    return {
+        "id": int(row["vod_id"]) if str(row["vod_id"]).isdigit() else row["vod_id"],
+        "name": row["vod_name"],
+        "typeId": row["vod_typeId"],
+        "typeId1": row["vod_typeId1"],
+        "remarks": row["vod_remarks"],
+        "vip": row["vod_is_vip"],
+        "episodes": row["vod_episodes"],
+        "pic": row["vod_urls"],
+        "new": row["vod_new"],
+        "version": row["vod_version"],
+        "score": row["vod_score"],
+        "year": row["vod_year"],
+    }
+
+
+class PrefixCompleter:
+    """
+    关键词补全：按归一化后的关键词排序的数组 + 二分查找前缀区间（压缩的前缀树，内存只有每个词一份），
+    区间内按热度取前 N 个，结果按前缀缓存，词的热度变化时只清掉它的各级前缀
+    - 热度来源：片库中的片名（基础分）、上游补全接口返回过的词、用户搜索过的词
+    """
+
+    def __init__(self, memo_size: int = AUTOCOMPLETE_MEMO_SIZE):
+        self._keys: list = []
+        self._words: dict = {}  # 归一化 key -> 展示用的原词
+        self._weights: dict = {}
+        self._bumps: dict = {}  # 非片库来源的热度，全量重建时保留
+        self._memo = LRUCache(maxsize=memo_size)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _set(self, word: str, weight: float) -> bool:
+        key = normalize(word)
+        if not key:
+            return False
+        if key not in self._words:
+            bisect.insort(self._keys, key)
+            self._words[key] = word
+        self._weights[key] = weight
+        for i in range(1, len(key) + 1):
+            self._memo.pop(key[:i], None)
+        return True
+
+    def insert(self, word: str, weight: float = 1.0):
+        """
+        加入片库中的词，已存在时取较高的基础分
+        """
+        key = normalize(word)
+        if weight > self._weights.get(key, 0) or key not in self._words:
+            self._set(word, max(weight, self._weights.get(key, 0)))
+
+    def bump(self, word: str, delta: float = 1.0, only_existing: bool = False):
+        """
+        增加热度
+        :param only_existing: 只增加已有词的热度（用户输入的搜索词不直接加入补全）
+        """
+        key = normalize(word)
+        if only_existing and key not in self._words:
+            return
+        if self._set(self._words.get(key, word), self._weights.get(key, 0) + delta):
+            self._bumps[key] = self._bumps.get(key, 0) + delta
+
+    def complete(self, prefix: str, limit: int = 10) -> list:
+        """
+        :return: 以 prefix 开头的词，按热度从高到低
+        """
+        query = normalize(prefix)
+        if not query:
+            return []
+        memo = self._memo.get(query)
+        if memo is None or len(memo) < limit:
+            lo = bisect.bisect_left(self._keys, query)
+            hi = bisect.bisect_left(self._keys, query + "\U0010ffff", lo)
+            memo = heapq.nlargest(limit, self._keys[lo:hi], key=lambda k: (self._weights[k], -len(k)))
+            self._memo[query] = memo
+        return [self._words[k] for k in memo[:limit]]
+
+    def rebuild(self, rows: list) -> "PrefixCompleter":
+        """
+        从片库全量重建，保留原有的热度
+        :param rows: vod_info 的行
+        :return: 新的 PrefixCompleter
+        """
+        completer = PrefixCompleter(self._memo.maxsize)
+        for row in rows:
+            key = normalize(row["vod_name"])
+            if key:
+                completer._words[key] = row["vod_name"]
+                completer._weights[key] = max(completer._weights.get(key, 0), _baseWeight(row))
+        bumps = dict(self._bumps)
+        for key, delta in bumps.items():
+            completer._words.setdefault(key, self._words.get(key, key))
+            completer._weights[key] = completer._weights.get(key, 0) + delta
+        completer._bumps = bumps
+        completer._keys = sorted(completer._words)
+        return completer
+
+
+def _baseWeight(row: dict) -> float:
+    # 片库中的片名基础分 1，评分高的略微靠前
+    return 1 + (row.get("vod_score") or 0) / 10
+
+
+class LocalSearchIndex:
+    """
+    vod_info.vod_name 的内存 n-gram 倒排索引
+    - 查询时取查询串所有 n-gram 倒排表的交集，再用子串匹配过滤
+    - 启动后全量载入，之后按自增 id 增量载入其他 worker 写入的新行，定期全量重建以获取更新
+    - 本 worker 的搜索结果通过 add_rows 立即进入索引
+    """
+
+    def __init__(self):
+        self._docs: dict = {}
+        self._names: dict = {}
+        self._postings: dict = {}
+        self._last_id = 0
+        self._last_rebuild = float("-inf")  # 首次刷新总是全量构建
+        self.completer = PrefixCompleter()
+
+    def __len__(self):
+        return len(self._docs)
+
+    @staticmethod
+    def _index(docs: dict, names: dict, postings: dict, row: dict):
+        vod_id = row["vod_id"]
+        old = names.get(vod_id)
+        name = normalize(row["vod_name"])
+        if old is not None and old != name:
+            for gram in _grams(old):
+                ids = postings.get(gram)
+                if ids is not None:
+                    ids.discard(vod_id)
+        docs[vod_id] = row
+        names[vod_id] = name
+        for gram in _grams(name):
+            postings.setdefault(gram, set()).add(vod_id)
+
+    def add_rows(self, rows: dict):
+        """
+        加入或更新索引
+        :param rows: {vod_id: row}，row 为 vod_info 的列
+        """
+        for row in rows.values():
+            self._index(self._docs, self._names, self._postings, row)
+            self.completer.insert(row["vod_name"], _baseWeight(row))
+
+    def search(self, keyword: str, page: int = 1, size: int = 4) -> dict:
+        """
+        按片名搜索
+        :return: 与上游搜索接口相同结构的响应
+        """
+        query = normalize(keyword)
+        matched = []
+        if query:
+            grams = sorted(_grams(query) if len(query) > 1 else {query},
+                           key=lambda g: len(self._postings.get(g, ())))
+            candidates = None
+            for gram in grams:
+                ids = self._postings.get(gram)
+                if not ids:
+                    candidates = set()
+                    break
+                candidates = set(ids) if candidates is None else candidates & ids
+                if not candidates:
+                    break
+            for vod_id in candidates or ():
+                name = self._names[vod_id]
+                if query in name:
+                    matched.append((0 if name == query else 1 if name.startswith(query) else 2, len(name),
+                                    -(self._docs[vod_id]["vod_score"] or 0), vod_id))
+        matched.sort()
+        start = max(page - 1, 0) * size
+        items = [_item(self._docs[m[-1]]) for m in matched[start:start + size]]
+        return {"code": 0, "data": {"total": len(matched), "data": [{"type": "vod", "list": items}]},
+                "msg": "local"}
+
+    @staticmethod
+    async def _load(after_id: int = 0) -> list:
+        columns = VodInfo.__table__.c
+        async with SessionLocal() as session:
+            result = await session.execute(select(VodInfo.__table__).where(columns.id > after_id).order_by(columns.id))
+            return [dict(r) for r in result.mappings().all()]
+
+    async def refresh(self):
+        """
+        增量载入新行；距上次全量重建超过 LOCAL_SEARCH_REBUILD_SECONDS 时全量重建
+        """
+        if time.monotonic() - self._last_rebuild >= LOCAL_SEARCH_REBUILD_SECONDS:
+            rows = await self._load()
+            docs, names, postings = {}, {}, {}
+
+            def build():
+                for row in rows:
+                    self._index(docs, names, postings, row)
+                return self.completer.rebuild(rows)
+
+            # 全量构建放到线程里，避免阻塞事件循环
+            completer = await asyncio.to_thread(build)
+            self._docs, self._names, self._postings = docs, names, postings
+            self.completer = completer
+            self._last_rebuild = time.monotonic()
+        else:
+            rows = await self._load(self._last_id)
+            self.add_rows({row["vod_id"]: row for row in rows})
+        if rows:
+            self._last_id = max(self._last_id, rows[-1]["id"])
+
+
+localIndex = LocalSearchIndex()
+
+
+@repeat_every(seconds=LOCAL_SEARCH_REFRESH_SECONDS, wait_first=LOCAL_SEARCH_REFRESH_SECONDS)
+async def refreshLocalIndex():
+    """
+    定时刷新本地搜索索引
+    """
+    try:
+        await localIndex.refresh()
+    except Exception as e:
+        logger.error(f"Failed to refresh local search index: {e}")
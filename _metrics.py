@@ -0,0 +1,237 @@
+"""
+进程内指标，Prometheus 文本格式输出
+
+每个 worker 只在内存中累加（普通 dict 操作，不加锁、不做 IO），每隔 METRICS_FLUSH_SECONDS 秒把快照写到
+METRICS_DIR/<pid>-<随机后缀>.json；/metrics 读取所有 worker 的快照（自己用内存中的最新值）求和后输出。
+已退出 worker 的文件保留，计数器不会因为 worker 重启而减少；METRICS_DIR 应该在容器启动时为空。
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from fastapi.routing import APIRouter
+from fastapi_utils.tasks import repeat_every
+from starlette.responses import PlainTextResponse
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = os.getenv("METRICS_DIR", "/tmp/oleapi-metrics")  # 为空时只输出当前 worker 的指标
+METRICS_FLUSH_SECONDS = int(os.getenv("METRICS_FLUSH_SECONDS", 5))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry: dict = {}
+_asyncCollectors: list = []
+_snapshotName = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+
+metricsRouter = APIRouter(tags=['Metrics'])
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: dict = {}
+        _registry[name] = self
+
+    def snapshot(self) -> list:
+        return [[list(k), v] for k, v in self._values.items()]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    快照时调用 fn 取值，各个 worker 的值求和
+    有 labels 时 fn 返回 {(label 值, ...): 值}
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], object], labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+
+    def snapshot(self) -> list:
+        try:
+            if self.labels:
+                return [[list(k), float(v)] for k, v in self.fn().items()]
+            return [[[], float(self.fn())]]
+        except Exception:
+            return []
+
+
+class CallbackCounter(Gauge):
+    """
+    由 fn 提供累计值的计数器，用于已经在别处计数的值
+    """
+    type = "counter"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        # [每个桶的计数..., +Inf 计数, 总和]
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-2] += 1
+        counts[-1] += value
+
+
+def register_async_collector(fn: Callable[[], Awaitable[list]]):
+    """
+    注册只在输出时执行一次的异步采集函数，用于所有 worker 共享的值（例如 redis 中的队列长度），不参与求和
+    :param fn: 返回 [(name, help, value)]
+    """
+    _asyncCollectors.append(fn)
+
+
+def _snapshot() -> dict:
+    return {m.name: {"type": m.type, "help": m.documentation, "labels": m.labels,
+                     "buckets": getattr(m, "buckets", None), "values": m.snapshot()}
+            for m in _registry.values()}
+
+
+def write_snapshot():
+    """
+    把当前 worker 的快照写到 METRICS_DIR
+    """
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, _snapshotName)
+    with open(path + ".tmp", "w") as f:
+        json.dump(_snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+@repeat_every(seconds=METRICS_FLUSH_SECONDS, wait_first=True)
+async def flushMetrics():
+    """
+    定时写快照
+    """
+    try:
+        write_snapshot()
+    except OSError as e:
+        logger.error(f"Failed to write metrics snapshot: {e}")
+
+
+def _merge(snapshots: list) -> dict:
+    merged: dict = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for labels, value in metric["values"]:
+                key = tuple(labels)
+                if isinstance(value, list):
+                    current = target["values"].get(key)
+                    target["values"][key] = value[:] if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    target["values"][key] = target["values"].get(key, 0) + value
+    return merged
+
+
+def _labelString(names, values, extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _formatValue(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render(merged: dict) -> str:
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in sorted(metric["values"].items()):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip(list(metric["buckets"]) + ["+Inf"], value[:-1]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _formatValue(bound)
+                    lines.append(f"{name}_bucket{_labelString(metric['labels'], labels, ('le', le))} {cumulative}")
+                lines.append(f"{name}_sum{_labelString(metric['labels'], labels)} {_formatValue(value[-1])}")
+                lines.append(f"{name}_count{_labelString(metric['labels'], labels)} {cumulative}")
+            else:
+                lines.append(f"{name}{_labelString(metric['labels'], labels)} {_formatValue(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def collect() -> dict:
+    """
+    所有 worker 的指标之和
+    """
+    snapshots = [_snapshot()]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        for filename in os.listdir(METRICS_DIR):
+            if not filename.endswith(".json") or filename == _snapshotName:
+                continue
+            path = os.path.join(METRICS_DIR, filename)
+            try:
+                stale = time.time() - os.path.getmtime(path) > METRICS_FLUSH_SECONDS * 3
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if stale:
+                # 已退出的 worker：保留累计值，丢掉瞬时值
+                snapshot = {name: metric for name, metric in snapshot.items() if metric["type"] != "gauge"}
+            snapshots.append(snapshot)
+    return _merge(snapshots)
+
+
+@metricsRouter.get('/metrics', include_in_schema=False)
+async def metrics():
+    merged = collect()
+    for fn in _asyncCollectors:
+        try:
+            for name, documentation, value in await fn():
+                merged[name] = {"type": "gauge", "help": documentation, "labels": (), "values": {(): value}}
+        except Exception:
+            continue
+    return PlainTextResponse(render(merged), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# === 指标定义 ===
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route and status",
+                                  ("method", "route", "status"))
+upstream_request_duration = Histogram("upstream_request_duration_seconds", "olelive upstream request latency",
+                                      ("endpoint",))
+upstream_errors = Counter("upstream_errors_total", "olelive upstream errors by endpoint and reason",
+                          ("endpoint", "reason"))
+redis_command_duration = Histogram("redis_command_duration_seconds", "Redis command latency", ("command",))
+mysql_query_duration = Histogram("mysql_query_duration_seconds", "MySQL statement latency", ("statement",))
+mysql_pool_checkout = Histogram("mysql_pool_checkout_seconds", "Time spent waiting for a MySQL pool connection")
+cache_requests = Counter("cache_requests_total", "SWR cache lookups by namespace and result",
+                         ("namespace", "result"))
+push_deliveries = Counter("push_deliveries_total", "Push notification deliveries by result", ("result",))
+push_retries = Counter("push_retries_total", "Push notification delivery retries")
+decrypt_errors = Counter("decrypt_errors_total", "Request payloads that failed to decrypt by kind", ("kind",))
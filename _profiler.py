@@ -0,0 +1,309 @@
+"""
+按需的采样性能分析
+- POST /admin/profile：所有 worker 同时采样 N 秒，返回折叠栈（flamegraph.pl / speedscope 可直接读取）
+- 请求头 X-Profile: <PROFILER_TOKEN>：只采样这一个请求，结果通过响应头 X-Profile-Id 查询
+未设置 PROFILER_TOKEN 时不订阅、不加中间件，没有任何额外开销
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+import weakref
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import Request
+from fastapi.routing import APIRouter
+from starlette.responses import JSONResponse, PlainTextResponse
+
+from _redis import redis_client
+
+logger = logging.getLogger(__name__)
+
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")  # 为空时关闭性能分析
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", 0.005))  # 采样间隔（秒）
+PROFILER_MAX_SECONDS = int(os.getenv("PROFILER_MAX_SECONDS", 60))
+PROFILE_CHANNEL = "profiler:start"
+PROFILE_RESULT_KEY = "profiler:result:"  # + 分析 id，hash: pid -> 折叠栈
+PROFILE_RESULT_TTL = 60 * 10
+PROFILE_HEADER = b"x-profile"
+
+profilerRouter = APIRouter(prefix='/admin', tags=['Admin'])
+
+_profiledRequest: ContextVar[Optional["StackSampler"]] = ContextVar("profiled_request", default=None)
+_listener: Optional[asyncio.Task] = None
+_running: Optional[asyncio.Task] = None
+_labels: dict = {}
+_taskOwners: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()  # task -> 所属请求的 StackSampler
+
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename
+        if "site-packages" in path:
+            path = path.split("site-packages", 1)[1].lstrip(os.sep)
+        else:
+            path = os.path.basename(path)
+        name = getattr(code, "co_qualname", code.co_name)
+        label = _labels[code] = f"{name} ({path}:{code.co_firstlineno})".replace(";", ":")
+    return label
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        stack.append(_label(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return ";".join(stack)
+
+
+class StackSampler:
+    """
+    后台线程定时读取 sys._current_frames()，按调用栈计数
+    - 全局分析采样所有线程（包括 RSA 解密等线程池），按线程名分组
+    - 单个请求的分析只采样事件循环线程，并且只在当前运行的 task 属于这个请求时计数
+    """
+
+    def __init__(self, interval: float = PROFILER_INTERVAL, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 root: str = ""):
+        self.interval = interval
+        self.loop = loop
+        self.root = root
+        self.counts: dict = {}
+        self.samples = 0
+        self._loopThread = threading.get_ident() if loop is not None else None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _belongs(self) -> bool:
+        task = asyncio.tasks._current_tasks.get(self.loop)
+        return task is not None and _taskOwners.get(task) is self
+
+    def sample(self):
+        own = threading.get_ident()
+        if self._loopThread is not None:
+            if not self._belongs():
+                return
+            frames = {self._loopThread: sys._current_frames().get(self._loopThread)}
+        else:
+            frames = sys._current_frames()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in frames.items():
+            if ident == own or frame is None:
+                continue
+            stack = _collapse(frame)
+            if self._loopThread is None:
+                stack = f"{names.get(ident, ident)};{stack}"
+            if self.root:
+                stack = f"{self.root};{stack}"
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """
+        :return: 折叠栈文本，每行 "帧;帧;帧 次数"
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.counts.items()))
+
+
+async def _save(profile_id: str, text: str):
+    key = PROFILE_RESULT_KEY + profile_id
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(key, str(os.getpid()), text)
+        pipe.expire(key, PROFILE_RESULT_TTL)
+        await pipe.execute()
+
+
+async def _profileWorker(profile_id: str, seconds: float):
+    sampler = StackSampler(root=f"pid-{os.getpid()}")
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        text = await asyncio.to_thread(sampler.stop)
+    await _save(profile_id, text)
+    logger.info(f"Profile {profile_id} finished: {sampler.samples} samples")
+
+
+def _startProfile(profile_id: str, seconds: float) -> bool:
+    global _running
+    if _running is not None and not _running.done():
+        return False
+    _running = asyncio.get_running_loop().create_task(_profileWorker(profile_id, seconds))
+    return True
+
+
+async def _listen():
+    """
+    订阅分析请求，redis 断开后自动重连
+    """
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(PROFILE_CHANNEL)
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                data = json.loads(message["data"])
+                if not _startProfile(data["id"], data["seconds"]):
+                    logger.warning(f"Profile {data['id']} ignored: another profile is running")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Profiler listener error: {e}")
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+
+def _installTaskFactory(loop: asyncio.AbstractEventLoop):
+    """
+    请求中创建的 task（例如 BaseHTTPMiddleware 的 call_next）继承 context，
+    创建时记录它属于哪个被分析的请求，采样线程据此判断当前运行的 task
+    """
+    previous = loop.get_task_factory()
+
+    def factory(loop, coro, **kwargs):
+        task = previous(loop, coro, **kwargs) if previous else asyncio.Task(coro, loop=loop, **kwargs)
+        sampler = _profiledRequest.get()
+        if sampler is not None:
+            _taskOwners[task] = sampler
+        return task
+
+    loop.set_task_factory(factory)
+
+
+async def start_profiler():
+    """
+    启动分析请求的订阅，在 lifespan 中调用
+    """
+    global _listener
+    if PROFILER_TOKEN and (_listener is None or _listener.done()):
+        loop = asyncio.get_running_loop()
+        _installTaskFactory(loop)
+        _listener = loop.create_task(_listen())
+
+
+async def stop_profiler():
+    """
+    停止订阅和正在进行的分析
+    """
+    global _listener
+    for task in (_listener, _running):
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+    _listener = None
+
+
+def _authorized(token) -> bool:
+    if isinstance(token, str):
+        token = token.encode()
+    return bool(PROFILER_TOKEN) and bool(token) and hmac.compare_digest(token, PROFILER_TOKEN.encode())
+
+
+async def _result(profile_id: str) -> str:
+    results = await redis_client.hgetall(PROFILE_RESULT_KEY + profile_id)
+    return "\n".join(v.decode() if isinstance(v, bytes) else v for _, v in sorted(results.items()) if v)
+
+
+@profilerRouter.api_route('/profile', methods=['POST'], include_in_schema=False)
+async def profile(request: Request, seconds: float = 10, scope: str = "all"):
+    """
+    采样 seconds 秒后返回折叠栈
+    :param seconds: 采样时长，最多 PROFILER_MAX_SECONDS
+    :param scope: all 所有 worker | self 只分析处理这个请求的 worker
+    """
+    if not _authorized(request.headers.get("Authorization", "").removeprefix("Bearer ")):
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+    seconds = min(max(seconds, 0.1), PROFILER_MAX_SECONDS)
+    profile_id = uuid.uuid4().hex
+    workers = 0
+    if scope == "all":
+        workers = await redis_client.publish(PROFILE_CHANNEL, json.dumps({"id": profile_id, "seconds": seconds}))
+    if not workers and not _startProfile(profile_id, seconds):
+        return JSONResponse(status_code=409, content={"detail": "Another profile is running"})
+    # 等待所有 worker 写入结果
+    deadline = time.monotonic() + seconds + 5
+    await asyncio.sleep(seconds)
+    while time.monotonic() < deadline:
+        if await redis_client.hlen(PROFILE_RESULT_KEY + profile_id) >= max(workers, 1):
+            break
+        await asyncio.sleep(0.2)
+    return PlainTextResponse(await _result(profile_id), headers={"X-Profile-Id": profile_id})
+
+
+@profilerRouter.api_route('/profile/{profile_id}', methods=['GET'], include_in_schema=False)
+async def profileResult(request: Request, profile_id: str):
+    """
+    查询分析结果（包括通过 X-Profile 请求头采样的单个请求）
+    """
+    if not _authorized(request.headers.get("Authorization", "").removeprefix("Bearer ")):
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+    text = await _result(profile_id)
+    if not text and not await redis_client.exists(PROFILE_RESULT_KEY + profile_id):
+        return JSONResponse(status_code=404, content={"detail": "Profile not found"})
+    return PlainTextResponse(text)
+
+
+class RequestProfilerMiddleware:
+    """
+    带 X-Profile: <PROFILER_TOKEN> 请求头的请求在处理期间采样事件循环线程，
+    响应头 X-Profile-Id 返回结果 id，通过 GET /admin/profile/{id} 获取
+    只在设置了 PROFILER_TOKEN 时添加
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = next((v for k, v in scope["headers"] if k == PROFILE_HEADER), None)
+        if not _authorized(token):
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+        sampler = StackSampler(loop=asyncio.get_running_loop(), root=f"{scope['method']} {scope['path']}")
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        context = _profiledRequest.set(sampler)
+        _taskOwners[asyncio.current_task()] = sampler
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            text = sampler.stop()
+            _profiledRequest.reset(context)
+            try:
+                await _save(profile_id, text)
+            except Exception as e:
+                logger.error(f"Failed to save request profile: {e}")
@@ -0,0 +1,141 @@
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import httpx
+
+from _metrics import Gauge, push_deliveries, push_retries
+from _upstream import PUSH_MAX_CONNECTIONS, get_client
+
+logger = logging.getLogger(__name__)
+
+# 同时投递的通知数，默认等于推送连接池大小，超出的请求只会在连接池中排队直到 PoolTimeout
+PUSH_CONCURRENCY = int(os.getenv("PUSH_CONCURRENCY", PUSH_MAX_CONNECTIONS))
+PUSH_PER_HOST_LIMIT = int(os.getenv("PUSH_PER_HOST_LIMIT", 8))  # 单个目标 host 的并发连接数
+PUSH_ATTEMPTS = int(os.getenv("PUSH_ATTEMPTS", 3))  # 单次投递内的重试次数，之后交给 stream 重新投递
+PUSH_BACKOFF_BASE = float(os.getenv("PUSH_BACKOFF_BASE", 0.5))
+PUSH_BACKOFF_MAX = float(os.getenv("PUSH_BACKOFF_MAX", 10))
+
+
+class PushDeliveryEngine:
+    """
+    推送投递引擎
+    - 全局并发上限 + 每个目标 host 的并发上限，避免压垮单个推送服务；
+      先取 host 槽位再取全局槽位，等待某个繁忙 host 的任务不占用全局槽位
+    - 网络错误、5xx、429 按指数退避 + 全抖动重试；其他 4xx 视为永久失败不重试；退避期间不占用任何槽位
+    - 等待繁忙 host 或退避中的投递计入 parked，消费者不把它们算作占用读取配额，一个 host 的积压不会挡住其他 host
+    - 记录吞吐量（最近 60 秒）和投递计数
+    """
+
+    def __init__(self, concurrency: int = PUSH_CONCURRENCY, per_host: int = PUSH_PER_HOST_LIMIT,
+                 attempts: int = PUSH_ATTEMPTS, backoff_base: float = PUSH_BACKOFF_BASE,
+                 backoff_max: float = PUSH_BACKOFF_MAX):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._hosts: dict = {}
+        self._recent = deque()
+        self.inflight = 0
+        self.parked = 0
+        self.released = asyncio.Event()  # 有投递进入 parked 时触发，消费者据此继续读取
+        self.delivered = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retries = 0
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        semaphore = self._hosts.get(host)
+        if semaphore is None:
+            semaphore = self._hosts[host] = asyncio.Semaphore(self.per_host)
+        return semaphore
+
+    @contextlib.contextmanager
+    def _parked(self):
+        self.parked += 1
+        self.released.set()
+        try:
+            yield
+        finally:
+            self.parked -= 1
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: [0, min(max, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def deliver(self, url: str, headers: dict = None) -> str:
+        """
+        投递一条通知
+        :param url: 推送地址
+        :param headers: 请求头
+        :return: success | failed（可重试） | rejected（永久失败）
+        """
+        result = await self._deliver(url, headers)
+        push_deliveries.inc(result)
+        if result == "success":
+            self.delivered += 1
+            now = time.monotonic()
+            self._recent.append(now)
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+        elif result == "rejected":
+            self.rejected += 1
+        else:
+            self.failed += 1
+        return result
+
+    async def _post(self, url: str, headers: dict = None) -> httpx.Response:
+        host = self._host_semaphore(url)
+        if host.locked():
+            with self._parked():
+                await host.acquire()
+        else:
+            await host.acquire()
+        try:
+            async with self._semaphore:
+                self.inflight += 1
+                try:
+                    return await get_client("push").post(url, headers=headers)
+                finally:
+                    self.inflight -= 1
+        finally:
+            host.release()
+
+    async def _deliver(self, url: str, headers: dict = None) -> str:
+        for attempt in range(self.attempts):
+            if attempt:
+                self.retries += 1
+                push_retries.inc()
+                with self._parked():
+                    await asyncio.sleep(self._backoff(attempt))
+            try:
+                response = await self._post(url, headers)
+            except httpx.HTTPError as e:
+                logger.warning(f"Push delivery error (attempt {attempt + 1}): {e}")
+                continue
+            if response.status_code == 200:
+                return "success"
+            if response.status_code != 429 and response.status_code < 500:
+                logger.error(f"Push rejected with status {response.status_code}: {url}")
+                return "rejected"
+            logger.warning(f"Push delivery failed with status {response.status_code} (attempt {attempt + 1})")
+        return "failed"
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        recent = sum(1 for t in self._recent if now - t <= 60)
+        return {"concurrency": self.concurrency, "inflight": self.inflight, "parked": self.parked,
+                "delivered": self.delivered, "failed": self.failed, "rejected": self.rejected,
+                "retries": self.retries, "throughput_per_minute": recent}
+
+
+pushEngine = PushDeliveryEngine()
+Gauge("push_inflight", "Push notifications being delivered", lambda: pushEngine.inflight)
@@ -1,12 +1,20 @@
+import asyncio
 import json
+import logging
 import os
+import time
 from typing import Optional
 
 import dotenv
+from cachetools import TLRUCache
 from redis import asyncio as redis
 
+from _metrics import CallbackCounter, Gauge, redis_command_duration
+
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Configuration
 if os.getenv("REDIS_CONN") is not None:
     REDIS_CONN = os.getenv("REDIS_CONN")
@@ -18,8 +26,149 @@ else:
     # 在集群环境下，使用 redis:// 连接字符串 并且 tcp()包裹
     REDIS_CONN = f"redis://default:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
 
+
+class _TimedPipeline(redis.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            redis_command_duration.observe(time.perf_counter() - start, "PIPELINE")
+
+
+class _TimedRedis(redis.Redis):
+    """
+    记录每个命令（整个 pipeline 记为一次 PIPELINE）的耗时
+    """
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            redis_command_duration.observe(time.perf_counter() - start, str(args[0]).upper())
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> _TimedPipeline:
+        return _TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
 # Initialize Redis client
-redis_client = redis.from_url(REDIS_CONN)
+redis_client = _TimedRedis.from_url(REDIS_CONN)
+
+# === L1 Cache Configuration ===
+# 进程内缓存热点 key，省掉一次 redis 往返；写入/删除时通过 pub/sub 通知所有 worker 失效
+L1_ENABLED = os.getenv("L1_CACHE_ENABLED", "true").lower() == "true"
+L1_INVALIDATE_CHANNEL = "l1:invalidate"
+# 命名空间: (匹配方式 exact | prefix, 最大条目数, ttl 秒)
+L1_NAMESPACES = {
+    "vv_override": ("exact", 1, 60),
+    "trending_v2_cache_": ("prefix", 64, 30),
+    "detail_": ("prefix", 1024, 30),
+    "crypto_session:": ("prefix", 4096, 60 * 5),
+}
+# === L1 Cache ===
+
+
+class _L1Namespace:
+    """
+    单个命名空间的 L1 缓存，条目过期时间取 命名空间 ttl 和 redis 剩余 ttl 的较小值
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.ttl = ttl
+        # value: (data, expire_at)
+        self.cache = TLRUCache(maxsize=maxsize, ttu=lambda _k, v, _now: v[1], timer=time.monotonic)
+        self.hits = 0
+        self.misses = 0
+
+
+_l1 = {name: _L1Namespace(maxsize, ttl) for name, (_, maxsize, ttl) in L1_NAMESPACES.items()}
+# 每次失效 +1，用于丢弃失效期间并发读回来的旧值
+_l1_epoch = 0
+_l1_listener: Optional[asyncio.Task] = None
+
+
+def _l1_namespace(key: str) -> Optional[_L1Namespace]:
+    if not L1_ENABLED:
+        return None
+    for name, (match, _, _) in L1_NAMESPACES.items():
+        if (match == "exact" and key == name) or (match == "prefix" and key.startswith(name)):
+            return _l1[name]
+    return None
+
+
+def _l1_evict(key: str):
+    global _l1_epoch
+    _l1_epoch += 1
+    ns = _l1_namespace(key)
+    if ns is not None:
+        ns.cache.pop(key, None)
+
+
+def l1_stats() -> dict:
+    """
+    L1 缓存命中统计
+    :return: {namespace: {"hits": int, "misses": int, "size": int}}
+    """
+    return {name: {"hits": ns.hits, "misses": ns.misses, "size": len(ns.cache)} for name, ns in _l1.items()}
+
+
+CallbackCounter("l1_cache_hits_total", "In-process L1 cache hits by namespace",
+                lambda: {(name,): ns.hits for name, ns in _l1.items()}, ("namespace",))
+CallbackCounter("l1_cache_misses_total", "In-process L1 cache misses by namespace",
+                lambda: {(name,): ns.misses for name, ns in _l1.items()}, ("namespace",))
+Gauge("l1_cache_entries", "In-process L1 cache entries by namespace",
+      lambda: {(name,): len(ns.cache) for name, ns in _l1.items()}, ("namespace",))
+
+
+async def _l1_listen():
+    """
+    订阅失效通知，redis 断开后自动重连；重连期间可能错过通知，所以重连后清空 L1
+    """
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(L1_INVALIDATE_CHANNEL)
+            for ns in _l1.values():
+                ns.cache.clear()
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                key = message["data"]
+                _l1_evict(key.decode() if isinstance(key, bytes) else key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"L1 invalidation listener error: {e}")
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+
+async def start_l1_invalidation():
+    """
+    启动 L1 失效监听，在 lifespan 中调用
+    """
+    global _l1_listener
+    if L1_ENABLED and (_l1_listener is None or _l1_listener.done()):
+        _l1_listener = asyncio.get_running_loop().create_task(_l1_listen())
+
+
+async def stop_l1_invalidation():
+    """
+    停止 L1 失效监听
+    """
+    global _l1_listener
+    if _l1_listener is not None:
+        _l1_listener.cancel()
+        try:
+            await _l1_listener
+        except (asyncio.CancelledError, Exception):
+            pass
+        _l1_listener = None
 
 
 async def test_redis():
@@ -68,7 +217,14 @@ async def set_key(key: str, value: str, ex: Optional[int] = None) -> bool:
     try:
         if type(value) is dict:
             value = json.dumps(value)
-        await redis_client.set(name=key, value=value, ex=ex)
+        if _l1_namespace(key) is None:
+            await redis_client.set(name=key, value=value, ex=ex)
+            return True
+        _l1_evict(key)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(name=key, value=value, ex=ex)
+            pipe.publish(L1_INVALIDATE_CHANNEL, key)
+            await pipe.execute()
         return True
     except redis.RedisError as e:
         print(f"Error setting key in Redis: {e}")
@@ -81,8 +237,25 @@ async def get_key(key: str) -> Optional[str]:
     Get a value from Redis by key. Returns None if the key does not exist.
     """
     # 返回 string
+    ns = _l1_namespace(key)
+    if ns is not None:
+        entry = ns.cache.get(key)
+        if entry is not None:
+            ns.hits += 1
+            return entry[0]
+        ns.misses += 1
     try:
-        data = await redis_client.get(key)
+        if ns is None:
+            data = await redis_client.get(key)
+        else:
+            epoch = _l1_epoch
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.pttl(key)
+                data, pttl = await pipe.execute()
+            if data and epoch == _l1_epoch:
+                ttl = ns.ttl if pttl is None or pttl < 0 else min(ns.ttl, pttl / 1000)
+                ns.cache[key] = (data.decode(), time.monotonic() + ttl)
         if data:
             return data.decode()
         else:
@@ -98,7 +271,14 @@ async def delete_key(key: str) -> bool:
     Delete a key from Redis.
     """
     try:
-        await redis_client.delete(key)
+        if _l1_namespace(key) is None:
+            await redis_client.delete(key)
+            return True
+        _l1_evict(key)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.delete(key)
+            pipe.publish(L1_INVALIDATE_CHANNEL, key)
+            await pipe.execute()
         return True
     except redis.RedisError as e:
         print(f"Error deleting key from Redis: {e}")
@@ -110,6 +290,12 @@ async def key_exists(key: str) -> bool:
     """
     Check if a key exists in Redis.
     """
+    ns = _l1_namespace(key)
+    if ns is not None:
+        if ns.cache.get(key) is not None:
+            ns.hits += 1
+            return True
+        ns.misses += 1
     try:
         return await redis_client.exists(key) == 1
     except redis.RedisError as e:
@@ -1,23 +1,71 @@
-import datetime
+import asyncio
 import json
 import logging
+import os
+import re
 from time import time
 
-import httpx
-from fastapi import BackgroundTasks, Depends
+from fastapi import Depends
 from fastapi.routing import APIRouter
 from fastapi_limiter.depends import RateLimiter
 from starlette.requests import Request
 from starlette.responses import JSONResponse, RedirectResponse
 
-from _crypto import decryptData
-from _db import cache_vod_data
-from _redis import delete_key as redis_delete_key, get_key as redis_get_key, key_exists as redis_key_exists, \
-    set_key as redis_set_key
+from _cache import SWRCache
+from _crypto import CryptoBusy, SessionExpired, decryptData, decryptSessionData
+from _db import vod_rows, vodWriter
+from _localsearch import localIndex
+from _upstream import olelive_get
 from _utils import _getRandomUserAgent, generate_vv_detail, url_encode
 
 searchRouter = APIRouter(prefix='/api/query/ole', tags=['Search', 'Search Api'])
 
+# soft ttl 之后返回旧数据并在后台刷新，hard ttl 之后才需要同步请求上游
+searchCache = SWRCache("search", soft_ttl=int(os.getenv("SEARCH_CACHE_SOFT_TTL", 60 * 60)),
+                       hard_ttl=int(os.getenv("SEARCH_CACHE_HARD_TTL", 60 * 60 * 24)))
+keywordCache = SWRCache("keyword", soft_ttl=int(os.getenv("KEYWORD_CACHE_SOFT_TTL", 60 * 60)),
+                        hard_ttl=int(os.getenv("KEYWORD_CACHE_HARD_TTL", 60 * 60 * 24)))
+
+# 完结的剧集基本不会再变，连载中的需要较快刷新
+DETAIL_TTL_FINISHED = (int(os.getenv("DETAIL_CACHE_FINISHED_SOFT_TTL", 60 * 60 * 24)),
+                       int(os.getenv("DETAIL_CACHE_FINISHED_HARD_TTL", 60 * 60 * 24 * 7)))
+DETAIL_TTL_AIRING = (int(os.getenv("DETAIL_CACHE_AIRING_SOFT_TTL", 60 * 10)),
+                     int(os.getenv("DETAIL_CACHE_AIRING_HARD_TTL", 60 * 60 * 6)))
+_FINISHED_REMARKS = re.compile(r"完结|全集|^全\d+集|^\d+集全")
+
+
+def _detailTTL(payload) -> tuple:
+    """
+    根据 remarks 判断是否完结，决定详情缓存时间
+    :param payload: 上游详情接口返回的数据
+    :return: (soft_ttl, hard_ttl)
+    """
+    try:
+        data = payload.get("data") or {}
+        remarks = str(data.get("remarks") or "")
+        # typeId 1 是电影，没有连载的概念
+        if _FINISHED_REMARKS.search(remarks) or data.get("typeId") == 1 or data.get("typeId1") == 1:
+            return DETAIL_TTL_FINISHED
+    except AttributeError:
+        pass
+    return DETAIL_TTL_AIRING
+
+
+def _detailCacheable(payload) -> bool:
+    # 只缓存上游返回成功的详情
+    return isinstance(payload, dict) and payload.get("code") == 0
+
+
+detailCache = SWRCache("detail", soft_ttl=DETAIL_TTL_AIRING[0], hard_ttl=DETAIL_TTL_AIRING[1], ttl=_detailTTL)
+DETAIL_BATCH_MAX_IDS = int(os.getenv("DETAIL_BATCH_MAX_IDS", 50))
+DETAIL_BATCH_CONCURRENCY = int(os.getenv("DETAIL_BATCH_CONCURRENCY", 8))  # 每个批量请求同时请求上游的数量
+DETAIL_BATCH_TIMEOUT = float(os.getenv("DETAIL_BATCH_TIMEOUT", 8))  # 单个 id 的超时时间（秒）
+# 本地搜索：off 不使用；fallback 上游超时/熔断/失败时使用；merge 另外用本地结果补齐第一页
+SEARCH_LOCAL_MODE = os.getenv("SEARCH_LOCAL_MODE", "fallback").lower()
+SEARCH_UPSTREAM_DEADLINE = float(os.getenv("SEARCH_UPSTREAM_DEADLINE", 3))
+AUTOCOMPLETE_LIMIT = int(os.getenv("AUTOCOMPLETE_LIMIT", 10))
+AUTOCOMPLETE_MIN_RESULTS = int(os.getenv("AUTOCOMPLETE_MIN_RESULTS", 5))  # 本地补全少于该数量时才请求上游
+
 
 async def _getProxy():
     return None  # 废弃接口，直接返回 None
@@ -37,7 +85,15 @@ async def checkSum(data):
         return JSONResponse({"error": "Invalid Request, missing param: timestamp"}, status_code=400,
                             headers={"X-Error": str(e)})
     try:
-        data = await decryptData(data.get('data'))
+        if data.get('session'):
+            # 握手后的请求使用 AES-GCM，不需要 RSA 运算
+            data = await decryptSessionData(data.get('session'), data.get('data'), timestamp)
+        else:
+            data = await decryptData(data.get('data'))
+    except SessionExpired:
+        return JSONResponse({"error": "Invalid Request, session expired"}, status_code=401)
+    except CryptoBusy:
+        return JSONResponse({"error": "Server Busy"}, status_code=503, headers={"Retry-After": "1"})
     except Exception as e:
         return JSONResponse({"error": "Invalid Request, invalid data"}, status_code=400)
     return json.loads(data)
@@ -63,15 +119,14 @@ async def search_api(keyword, page=1, size=4):
     vv = await generate_vv_detail()
     # 关键词是个中文字符串，需要进行 URL 编码
     keyword = url_encode(keyword)
-    base_url = f"https://api.olelive.com/v1/pub/index/search/{keyword}/vod/0/{page}/{size}?_vv={str(vv)}"
+    base_url = f"/v1/pub/index/search/{keyword}/vod/0/{page}/{size}?_vv={str(vv)}"
     headers = {
         'User-Agent': _getRandomUserAgent(),
         'Referer': 'https://www.olevod.com/',
         'Origin': 'https://www.olevod.com/',
     }
     logging.info(f"Search API: {base_url}")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(base_url, headers=headers)
+    response = await olelive_get("search", base_url, headers=headers)
     if response.status_code != 200:
         logging.error(f"Upstream Error, base_url: {base_url}, headers: {headers}")
         raise Exception("Upstream Error")
@@ -84,7 +139,7 @@ async def link_keywords(keyword):
         vv = vv.decode()
     # 关键词是个中文字符串，需要进行 URL 编码
     keyword_encoded = url_encode(keyword)
-    base_url = f"https://api.olelive.com/v1/pub/index/search/keywords/{keyword_encoded}?_vv={vv}"
+    base_url = f"/v1/pub/index/search/keywords/{keyword_encoded}?_vv={vv}"
     headers = {
         'User-Agent': _getRandomUserAgent(),
         'Referer': 'https://www.olevod.com/',
@@ -96,10 +151,10 @@ async def link_keywords(keyword):
         'accept-encoding': 'gzip, deflate, br, zstd',
         'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8,zh-TW;q=0.7',
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.get(base_url, headers=headers)
+    response = await olelive_get("keywords", base_url, headers=headers)
     if response.status_code != 200:
-        return JSONResponse(content={"error": "Upstream Error"}, status_code=507)
+        logging.error(f"Upstream Error, base_url: {base_url}, status: {response.status_code}")
+        raise Exception("Upstream Error")
     try:
         words = response.json()["data"][0]["words"]
         words = [word for word in words if word != "" and word != keyword]
@@ -115,41 +170,97 @@ async def link_keywords(keyword):
 
 @searchRouter.api_route('/search', dependencies=[Depends(RateLimiter(times=3, seconds=1))], methods=['POST'],
                         name='search')
-async def search(request: Request, background_tasks: BackgroundTasks):
+async def search(request: Request):
     data = await request.json()
     data = await checkSum(data)
+    if isinstance(data, JSONResponse):
+        return data
     keyword, page, size = data.get('keyword'), data.get('page'), data.get('size')
     if keyword == '' or keyword == 'your keyword':
         return JSONResponse({}, status_code=200)
     page, size = int(page), int(size)
+    id = f"search_{keyword}_{page}_{size}"
+    localIndex.completer.bump(keyword, only_existing=True)
+
+    async def _fetch():
+        # 只有拿到 flight 的请求（或后台刷新）会执行
+        r = await search_api(keyword, page, size)
+        if r and r['data']['total'] != 0:
+            # 条目缺字段时只跳过写库和索引，不影响本次搜索和缓存
+            try:
+                rows = vod_rows(r)
+            except (KeyError, TypeError) as e:
+                logging.error(f"Error while caching data: {e}")
+            else:
+                vodWriter.add_rows(rows)
+                localIndex.add_rows(rows)
+        return r
+
+    fetch = asyncio.ensure_future(
+        searchCache.get_or_fetch(id, _fetch, should_cache=lambda r: bool(r) and r['data']['total'] != 0))
+    # 超时返回本地结果后没有人再等待 fetch，取走它的异常
+    fetch.add_done_callback(lambda t: t.cancelled() or t.exception())
     try:
-        id = f"search_{keyword}_{page}_{size}_{datetime.datetime.now().strftime('%Y-%m-%d')}"
-        if await redis_key_exists(id):
-            data = json.loads(await redis_get_key(id))
-            data["msg"] = "cached"
-            return JSONResponse(data)
-    except Exception as e:
-        pass
-    try:
-        result = await search_api(keyword, page, size)
+        if SEARCH_LOCAL_MODE == "off":
+            cached = await fetch
+        else:
+            try:
+                # shield：超时后上游请求仍在后台继续并写入缓存
+                cached = await asyncio.wait_for(asyncio.shield(fetch), timeout=SEARCH_UPSTREAM_DEADLINE)
+            except asyncio.TimeoutError:
+                local = localIndex.search(keyword, page, size)
+                if local['data']['total'] != 0:
+                    return JSONResponse(local, headers={"X-Search-Source": "local"})
+                # 本地没有结果，继续等上游（受上游读取超时限制）
+                cached = await fetch
     except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=503)
+        local = localIndex.search(keyword, page, size) if SEARCH_LOCAL_MODE != "off" else None
+        if local and local['data']['total'] != 0:
+            return JSONResponse(local, headers={"X-Search-Source": "local"})
+        return JSONResponse({"error": str(e) or "Upstream Timeout"}, status_code=503)
+    result = cached.value
+    if cached.status != "MISS":
+        result["msg"] = "cached"
+    if SEARCH_LOCAL_MODE == "merge" and page == 1:
+        result = _mergeLocal(result, localIndex.search(keyword, 1, size), size)
     if result and result['data']['total'] == 0:
         return JSONResponse({"error": "No result Found"}, status_code=200)
-    if result:
-        background_tasks.add_task(cache_vod_data, result)
-        background_tasks.add_task(redis_set_key, id, json.dumps(result), ex=86400)  # 缓存一天
     try:
-        return JSONResponse(result)
+        return JSONResponse(result, headers=cached.headers())
     except:
         return JSONResponse(json.dumps(result), status_code=200)
 
 
+def _mergeLocal(result, local, size):
+    """
+    第一页上游结果不足 size 条时用本地结果补齐（按 id 去重），不修改缓存中的对象
+    """
+    if not result or not local['data']['total']:
+        return result
+    groups = result['data']['data']
+    index = next((i for i, d in enumerate(groups) if d.get('type') == 'vod'), None)
+    items = groups[index]['list'] if index is not None else []
+    seen = {str(item.get('id')) for item in items}
+    extra = [item for item in local['data']['data'][0]['list'] if str(item['id']) not in seen]
+    extra = extra[:max(size - len(items), 0)]
+    if not extra:
+        return result
+    merged = {"type": "vod", "list": items + extra}
+    if index is None:
+        groups = groups + [merged]
+    else:
+        groups = groups[:index] + [{**groups[index], **merged}] + groups[index + 1:]
+    total = max(result['data']['total'], len(items) + len(extra))
+    return {**result, "data": {**result['data'], "total": total, "data": groups}}
+
+
 @searchRouter.api_route('/keyword', dependencies=[Depends(RateLimiter(times=2, seconds=1))], methods=['POST'],
                         name='keyword')
 async def keyword(request: Request):
     data = await request.json()
     data = await checkSum(data)
+    if isinstance(data, JSONResponse):
+        return data
     keyword = data.get('keyword')
     if keyword == '' or keyword == 'your keyword':
         return JSONResponse({}, status_code=200)
@@ -157,51 +268,142 @@ async def keyword(request: Request):
         return JSONResponse(
             {"code": 0, "data": [{"type": "vod", "words": ["每一个未来的瞬间", "都有你的名字", "Yuki Forever💗"]}],
              "msg": "ok"}, status_code=200)
-    redis_key = f"keyword_{datetime.datetime.now().strftime('%Y-%m-%d')}_{keyword}"
+    # 本地补全足够时不请求上游
+    words = [w for w in localIndex.completer.complete(keyword, AUTOCOMPLETE_LIMIT + 1) if w != keyword]
+    words = words[:AUTOCOMPLETE_LIMIT]
+    if len(words) >= AUTOCOMPLETE_MIN_RESULTS:
+        return JSONResponse({"code": 0, "data": [{"type": "vod", "words": words}], "msg": "local"},
+                            headers={"X-Search-Source": "local"})
+    redis_key = f"keyword_{keyword}"
+
+    async def _fetch():
+        r = await link_keywords(keyword)
+        try:
+            for word in r["data"][0]["words"]:
+                localIndex.completer.bump(word)
+        except (KeyError, IndexError, TypeError):
+            pass
+        return r
+
     try:
-        if await redis_get_key(redis_key):
-            data = await redis_get_key(redis_key)
-            data = json.loads(data)
+        cached = await keywordCache.get_or_fetch(redis_key, _fetch)
+        data = cached.value
+        if cached.status != "MISS":
             data["msg"] = "cached"
-        else:
-            data = await link_keywords(keyword)
-            await redis_set_key(redis_key, json.dumps(data), ex=86400)  # 缓存一天
     except Exception as e:
+        if words:
+            return JSONResponse({"code": 0, "data": [{"type": "vod", "words": words}], "msg": "local"},
+                                headers={"X-Search-Source": "local"})
         logging.error("Error: " + str(e), stack_info=True)
         return JSONResponse({"error": str(e)}, status_code=501)
     try:
-        return JSONResponse(data)
+        return JSONResponse(data, headers=cached.headers())
     except:
         return JSONResponse(json.loads(data), status_code=200)
 
 
+async def fetch_detail(id):
+    """
+    请求上游详情接口
+    :param id: vod id
+    :return: 上游返回的数据
+    """
+    vv = await generate_vv_detail()
+    url = f"/v1/pub/vod/detail/{id}/true?_vv={vv}"
+    headers = {
+        'User-Agent': _getRandomUserAgent(),
+        'Referer': 'https://www.olevod.com/',
+        'Origin': 'https://www.olevod.com/',
+    }
+    response = await olelive_get("detail", url, headers=headers)
+    if response.status_code != 200:
+        logging.error(f"Upstream Error, url: {url}, status: {response.status_code}")
+        raise Exception("Upstream Error")
+    return response.json()
+
+
+async def get_detail(id):
+    """
+    读取详情，优先使用缓存
+    :param id: vod id
+    :return: CacheResult
+    """
+    return await detailCache.get_or_fetch(f"detail_{id}", lambda: fetch_detail(id), should_cache=_detailCacheable)
+
+
 @searchRouter.api_route('/detail', methods=['POST'], name='detail',
-                        dependencies=[Depends(RateLimiter(times=1, seconds=3))])
+                        dependencies=[Depends(RateLimiter(times=3, seconds=1))])
 async def detail(request: Request):
     data = await request.json()
     data = await checkSum(data)
+    if isinstance(data, JSONResponse):
+        return data
     try:
         id = data.get('id')
+        if id is None or str(id) == '':
+            raise ValueError("id is empty")
     except Exception as e:
         return JSONResponse({"error": "Invalid Request, missing param: id"}, status_code=400,
                             headers={"X-Error": str(e)})
-    vv = await generate_vv_detail()
-    url = f"https://api.olelive.com/v1/pub/vod/detail/{id}/true?_vv={vv}"
-    headers = {
-        'User-Agent': _getRandomUserAgent(),
-        'Referer': 'https://www.olevod.com/',
-        'Origin': 'https://www.olevod.com/',
-    }
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
-        response_data = response.json()
-        return JSONResponse(response_data, status_code=200)
+        cached = await get_detail(id)
+        return JSONResponse(cached.value, status_code=200, headers=cached.headers())
     except:
         return JSONResponse({"error": "Upstream Error"}, status_code=501)
     # direct play https://player.viloud.tv/embed/play?url=https://www.olevod.com/vod/detail/5f4b3b7b7f3c1d0001b2b3b3&autoplay=1
 
 
+@searchRouter.api_route('/detail/batch', methods=['POST'], name='detail_batch',
+                        dependencies=[Depends(RateLimiter(times=1, seconds=1))])
+async def detail_batch(request: Request):
+    """
+    批量获取详情，先读缓存，未命中的 id 再以有限并发请求上游
+    请求：checkSum 加密的 {"ids": [id1, id2, ...]}
+    返回：{"code": 0, "data": {id: {"status": "ok", "cache": "HIT", "data": {...}} | {"status": "error", "error": str}}}
+    """
+    data = await request.json()
+    data = await checkSum(data)
+    if isinstance(data, JSONResponse):
+        return data
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        return JSONResponse({"error": "Invalid Request, missing param: ids"}, status_code=400)
+    # 去重并保持顺序
+    ids = list(dict.fromkeys(str(i) for i in ids if str(i) != ''))
+    if len(ids) > DETAIL_BATCH_MAX_IDS:
+        return JSONResponse({"error": f"Invalid Request, at most {DETAIL_BATCH_MAX_IDS} ids"}, status_code=400)
+
+    results = {}
+    cached = await asyncio.gather(*[detailCache.read(f"detail_{i}") for i in ids], return_exceptions=True)
+    misses = []
+    for i, entry in zip(ids, cached):
+        if isinstance(entry, Exception) or entry is None or entry.status == "EXPIRED":
+            misses.append(i)
+            continue
+        if entry.status == "STALE":
+            # 后台刷新，立即返回旧数据；刷新不占用本次请求的并发和超时
+            detailCache.revalidate(f"detail_{i}", lambda i=i: fetch_detail(i), should_cache=_detailCacheable)
+        results[i] = {"status": "ok", "cache": entry.status, "data": entry.value}
+
+    semaphore = asyncio.Semaphore(DETAIL_BATCH_CONCURRENCY)
+
+    async def _fetch(i):
+        # 每个 id 独立超时，慢的 id 不会拖住其他 id
+        async with semaphore:
+            try:
+                entry = await asyncio.wait_for(get_detail(i), timeout=DETAIL_BATCH_TIMEOUT)
+                results[i] = {"status": "ok", "cache": entry.status, "data": entry.value}
+            except asyncio.TimeoutError:
+                results[i] = {"status": "error", "error": "Upstream Timeout"}
+            except Exception as e:
+                logging.error(f"Failed to fetch detail {i}: {e}")
+                results[i] = {"status": "error", "error": "Upstream Error"}
+
+    await asyncio.gather(*[_fetch(i) for i in misses])
+    return JSONResponse({"code": 0, "data": {i: results[i] for i in ids}, "msg": "ok"}, status_code=200,
+                        headers={"X-Cache-Hits": str(len(ids) - len(misses)), "X-Cache-Misses": str(len(misses))})
+
+
 @searchRouter.api_route('/report/keyword', methods=['POST', 'PUT'], name='report_keyword',
                         dependencies=[Depends(RateLimiter(times=1, seconds=3))])
 async def report_keyword(request: Request):
@@ -212,13 +414,14 @@ async def report_keyword(request: Request):
     data = await request.json()
     # print(data, "checkpoint 1")
     data = await checkSum(data)
+    if isinstance(data, JSONResponse):
+        return data
     # print(data, "checkpoint 2")
     keyword = data.get('keyword')
     if keyword == '' or keyword == 'your keyword':
         return JSONResponse({}, status_code=200)
     try:
-        key = f"keyword_{datetime.datetime.now().strftime('%Y-%m-%d')}_{keyword}"
-        await redis_delete_key(key)
+        await keywordCache.invalidate(f"keyword_{keyword}")
     except Exception as e:
         logging.error("Error: " + str(e), stack_info=True)
         return JSONResponse({"error": 'trace stack b1'}, status_code=501)
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from _redis import redis_client
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_LOCK_TTL = int(os.getenv("SINGLEFLIGHT_LOCK_TTL", 10))  # 跨 worker 锁的过期时间（秒）
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", 0.05))
+
+# 只有持有者本人才能释放锁，避免锁过期后误删别人的锁
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    合并同一个 key 的并发请求，同一时间只有一个上游请求在跑，其余调用者等待同一个结果
+    - worker 内：共享同一个 asyncio.Future
+    - worker 间：通过 redis 的 SET NX 短锁，没拿到锁的 worker 轮询 lookup() 等待持锁者写入缓存
+    """
+
+    def __init__(self, namespace: str, lock_ttl: int = SINGLEFLIGHT_LOCK_TTL):
+        self.namespace = namespace
+        self.lock_ttl = lock_ttl
+        self._inflight: dict = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable], lookup: Optional[Callable[[], Awaitable]] = None):
+        """
+        执行 fn，相同 key 的并发调用只会执行一次
+        :param key: 合并的 key，一般就是缓存的 redis key
+        :param fn: 真正请求上游的协程函数
+        :param lookup: 读取缓存的协程函数，返回 None 表示还没有结果；不传则只做 worker 内合并
+        :return: fn 的返回值
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            # 上游请求放在独立的 task 中，单个调用者被取消（超时）不会影响其他等待者和缓存写入
+            task = asyncio.get_running_loop().create_task(self._run(key, fn, lookup))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有调用者都已取消时避免 "exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable], lookup: Optional[Callable[[], Awaitable]]):
+        if lookup is None:
+            return await fn()
+        lock_key = f"lock:{self.namespace}:{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = await redis_client.set(lock_key, token, nx=True, ex=self.lock_ttl)
+        except Exception as e:
+            # redis 不可用时退化成只做 worker 内合并
+            logger.error(f"Failed to acquire singleflight lock {lock_key}: {e}")
+            return await fn()
+        if acquired:
+            try:
+                return await fn()
+            finally:
+                try:
+                    await redis_client.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+                except Exception as e:
+                    logger.error(f"Failed to release singleflight lock {lock_key}: {e}")
+        # 其他 worker 正在请求上游，等它把结果写进缓存
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_ttl
+        while loop.time() < deadline:
+            await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            result = await lookup()
+            if result is not None:
+                return result
+            try:
+                if not await redis_client.exists(lock_key):
+                    break
+            except Exception:
+                break
+        # 持锁者失败或者结果不可缓存，自己去请求
+        result = await lookup()
+        if result is not None:
+            return result
+        return await fn()
@@ -1,6 +1,5 @@
-import datetime
-import json
 import logging
+import os
 from json import JSONDecodeError
 from typing import Optional
 
@@ -11,11 +10,15 @@ from fastapi_limiter.depends import RateLimiter
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 
-from _redis import get_key, set_key
+from _cache import SWRCache
+from _upstream import olelive_get
 from _utils import _getRandomUserAgent, generate_vv_detail as gen_vv
 
 trendingRoute = APIRouter(prefix='/api/trending', tags=['Trending'])
 
+trendingCache = SWRCache("trending_v2", soft_ttl=int(os.getenv("TRENDING_CACHE_SOFT_TTL", 60 * 10)),
+                         hard_ttl=int(os.getenv("TRENDING_CACHE_HARD_TTL", 60 * 60 * 24)))
+
 
 async def gen_url(typeID: int, period: str, amount=10):
     """
@@ -28,7 +31,7 @@ async def gen_url(typeID: int, period: str, amount=10):
         return JSONResponse(status_code=400, content={
             'error': 'Invalid typeID parameter, must be one of: 1 --> 电影, 2 --> 电视剧（连续剧）, 3 --> 综艺, 4 --> 动漫'})
     vv = await gen_vv()
-    url = f"https://api.olelive.com/v1/pub/index/vod/data/rank/{period}/{typeID}/{amount}?_vv={vv}"
+    url = f"/v1/pub/index/vod/data/rank/{period}/{typeID}/{amount}?_vv={vv}"
     return url
 
 
@@ -40,7 +43,7 @@ async def gen_url_v2(typeID: int, amount=10):
         return JSONResponse(status_code=400, content={
             'error': 'Invalid typeID parameter, must be one of: 1 --> 电影, 2 --> 电视剧（连续剧）, 3 --> 综艺, 4 --> 动漫'})
     vv = await gen_vv()
-    url = f"https://api.olelive.com/v1/pub/index/vod/hot/{typeID}/0/{amount}?_vv={vv}"
+    url = f"/v1/pub/index/vod/hot/{typeID}/0/{amount}?_vv={vv}"
     return url
 
 
@@ -85,10 +88,9 @@ async def fetch_trending_data(request: Request, period: Optional[str] = 'day'):
     url = await gen_url(typeID, period, amount=10)
     logging.info(f"Fetching trending data from: {url}")
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers={'User-Agent': _getRandomUserAgent()}, timeout=30)
-            data = response.json()
-            return JSONResponse(status_code=200, content=data)
+        response = await olelive_get("rank", url, headers={'User-Agent': _getRandomUserAgent()})
+        data = response.json()
+        return JSONResponse(status_code=200, content=data)
     except httpx.RequestError as e:
         print(data)
         return JSONResponse(status_code=500, content={'error': f"An error occurred: {e}"})
@@ -124,20 +126,21 @@ async def fetch_trending_data_v2(request: Request, typeID: Optional[int] = None)
         logging.error(f"typeID: {typeID}, hint:typeID not in [1,2,3,4]")
         return JSONResponse(status_code=400, content={
             'error': 'Invalid typeID parameter, must be one of: 1 --> 电影, 2 --> 电视剧（连续剧）, 3 --> 综艺, 4 --> 动漫'})
-    redis_key = f"trending_v2_cache_{datetime.datetime.now().strftime('%Y-%m-%d')}_{typeID}_{amount}"
-    if await get_key(redis_key):
-        logging.info(f"Hit cache for key: {redis_key}")
-        data = await get_key(redis_key)
-        data = json.loads(data)
-        return JSONResponse(status_code=200, content=data)
-    else:
+    redis_key = f"trending_v2_cache_{typeID}_{amount}"
+
+    async def _fetch():
         url = await gen_url_v2(typeID, amount)
         logging.info(f"Fetching trending data from: {url}")
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, headers={'User-Agent': _getRandomUserAgent()}, timeout=30)
-                data = json.dumps(response.json())
-                await set_key(redis_key, data, 60 * 60 * 24)
-                return JSONResponse(status_code=200, content=json.loads(data))
-        except httpx.RequestError as e:
-            return JSONResponse(status_code=500, content={'error': f"An error occurred: {e}"})
+        response = await olelive_get("hot", url, headers={'User-Agent': _getRandomUserAgent()})
+        response.raise_for_status()  # 上游错误不写入缓存
+        return response.json()
+
+    try:
+        cached = await trendingCache.get_or_fetch(redis_key, _fetch)
+        if cached.status != "MISS":
+            logging.info(f"Hit cache for key: {redis_key}")
+        return JSONResponse(status_code=200, content=cached.value, headers=cached.headers())
+    except httpx.RequestError as e:
+        return JSONResponse(status_code=500, content={'error': f"An error occurred: {e}"})
+    except httpx.HTTPStatusError as e:
+        return JSONResponse(status_code=500, content={'error': f"An HTTP error occurred: {e}"})
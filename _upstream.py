@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+import dotenv
+import httpx
+
+from _metrics import Gauge, upstream_errors, upstream_request_duration
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# === UPSTREAM Configuration ===
+OLE_API_BASE = os.getenv("OLE_API_BASE", "https://api.olelive.com").rstrip("/")
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 50))  # 单个 host 的最大连接数
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", 20))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 60))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 10))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", 5))
+PUSH_MAX_CONNECTIONS = int(os.getenv("PUSH_MAX_CONNECTIONS", 20))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))  # 连续失败多少次后熔断
+BREAKER_RECOVERY_TIMEOUT = float(os.getenv("BREAKER_RECOVERY_TIMEOUT", 30))  # 熔断多久后尝试半开
+AIMD_INITIAL_LIMIT = float(os.getenv("AIMD_INITIAL_LIMIT", 20))
+AIMD_MIN_LIMIT = float(os.getenv("AIMD_MIN_LIMIT", 2))
+AIMD_MAX_LIMIT = float(os.getenv("AIMD_MAX_LIMIT", UPSTREAM_MAX_CONNECTIONS))
+AIMD_LATENCY_TARGET = float(os.getenv("AIMD_LATENCY_TARGET", 2))  # 超过该延迟（秒）视为拥塞
+# === UPSTREAM ===
+
+# 每个上游 host 一个长连接池的 client，由 app.py 的 lifespan 负责创建和关闭
+_clients: dict = {}
+
+
+class UpstreamUnavailable(httpx.RequestError):
+    """
+    熔断或并发超限时直接失败，请求不会发往上游
+    """
+
+
+class CircuitBreaker:
+    """
+    单个上游接口的熔断器
+    - closed：正常放行，连续失败达到阈值后进入 open
+    - open：直接失败，recovery_timeout 之后进入 half_open
+    - half_open：只放行一个探测请求，成功则 closed，失败则重新 open
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 recovery_timeout: float = BREAKER_RECOVERY_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                return False
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.probing:
+                self.rejected += 1
+                return False
+            self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != "closed":
+            self._transition("closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            if self.state != "open":
+                self._transition("open")
+
+    def _transition(self, state: str):
+        logger.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+class AIMDLimiter:
+    """
+    自适应并发限制：成功且延迟正常时线性增加上限，失败或延迟过高时减半
+    超过上限的请求直接失败，避免请求堆积在事件循环上
+    """
+
+    def __init__(self, initial: float = AIMD_INITIAL_LIMIT, min_limit: float = AIMD_MIN_LIMIT,
+                 max_limit: float = AIMD_MAX_LIMIT, latency_target: float = AIMD_LATENCY_TARGET):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.inflight = 0
+        self.rejected = 0
+        self._last_decrease = 0.0
+
+    def acquire(self) -> bool:
+        if self.inflight >= int(self.limit):
+            self.rejected += 1
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self, ok: bool, latency: float):
+        self.inflight -= 1
+        if ok and latency < self.latency_target:
+            # 每个"窗口"（约 limit 个请求）加 1
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            return
+        now = time.monotonic()
+        # 同一批超时的请求只减半一次
+        if now - self._last_decrease >= self.latency_target:
+            self.limit = max(self.min_limit, self.limit / 2)
+            self._last_decrease = now
+
+    def snapshot(self) -> dict:
+        return {"limit": round(self.limit, 2), "inflight": self.inflight, "rejected": self.rejected}
+
+
+_breakers: dict = {}
+_limiter = AIMDLimiter()
+
+
+def _get_breaker(endpoint: str) -> CircuitBreaker:
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+
+def upstream_status() -> dict:
+    """
+    上游熔断器和并发限制的状态
+    :return: dict
+    """
+    return {"breakers": {name: b.snapshot() for name, b in _breakers.items()}, "limiter": _limiter.snapshot()}
+
+
+# 每个 worker 在当前状态上记 1，求和后是处于该状态的 worker 数，例如 state="open" > 0 时告警
+Gauge("upstream_circuit_state", "Workers whose olelive circuit breaker is in each state, by endpoint",
+      lambda: {(name, state): int(b.state == state)
+               for name, b in _breakers.items() for state in ("closed", "half_open", "open")},
+      ("endpoint", "state"))
+
+
+def _http2_enabled() -> bool:
+    """
+    HTTP/2 依赖可选的 h2 包，没有安装时退回 HTTP/1.1
+    """
+    if not UPSTREAM_HTTP2:
+        return False
+    try:
+        import h2  # noqa
+        return True
+    except ImportError:
+        logger.warning("UPSTREAM_HTTP2 is set but the h2 package is not installed, falling back to HTTP/1.1")
+        return False
+
+
+def _build_client(name: str) -> httpx.AsyncClient:
+    """
+    创建带连接池的 AsyncClient
+    :param name: olelive | push
+    :return: httpx.AsyncClient
+    """
+    if name == "olelive":
+        limits = httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS,
+                              max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                              keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY)
+        return httpx.AsyncClient(base_url=OLE_API_BASE, http2=_http2_enabled(), limits=limits,
+                                 timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT,
+                                                       pool=UPSTREAM_POOL_TIMEOUT))
+    # push 的目标 host 不固定（bark 等），不设置 base_url
+    limits = httpx.Limits(max_connections=PUSH_MAX_CONNECTIONS,
+                          max_keepalive_connections=PUSH_MAX_CONNECTIONS,
+                          keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY)
+    return httpx.AsyncClient(limits=limits,
+                             timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT,
+                                                   pool=UPSTREAM_POOL_TIMEOUT))
+
+
+async def init_upstream():
+    """
+    初始化上游 client，在 lifespan 启动时调用
+    :return:
+    """
+    for name in ("olelive", "push"):
+        if name not in _clients or _clients[name].is_closed:
+            _clients[name] = _build_client(name)
+    logger.info("Upstream clients initialized, base: %s", OLE_API_BASE)
+    return True
+
+
+async def close_upstream():
+    """
+    关闭所有上游 client，释放 keep-alive 连接
+    :return:
+    """
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"Failed to close upstream client {name}: {e}")
+        _clients.pop(name, None)
+
+
+def get_client(name: str = "olelive") -> httpx.AsyncClient:
+    """
+    获取共享的上游 client，lifespan 之外（脚本、测试）调用时按需创建
+    :param name: olelive | push
+    :return: httpx.AsyncClient
+    """
+    client: Optional[httpx.AsyncClient] = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _clients[name] = _build_client(name)
+    return client
+
+
+async def olelive_get(endpoint: str, url: str, headers: Optional[dict] = None) -> httpx.Response:
+    """
+    经过熔断器和并发限制请求 olelive 上游
+    :param endpoint: 接口名，每个接口独立熔断：search | keywords | detail | rank | hot
+    :param url: 相对 OLE_API_BASE 的路径
+    :param headers: 请求头
+    :return: httpx.Response
+    :raises UpstreamUnavailable: 熔断或并发超限
+    """
+    breaker = _get_breaker(endpoint)
+    if not breaker.allow():
+        upstream_errors.inc(endpoint, "circuit_open")
+        raise UpstreamUnavailable(f"Upstream {endpoint} circuit open")
+    if not _limiter.acquire():
+        # 没有真正请求上游，半开状态的探测名额要还回去
+        breaker.probing = False
+        upstream_errors.inc(endpoint, "concurrency_limit")
+        raise UpstreamUnavailable(f"Upstream concurrency limit reached ({int(_limiter.limit)})")
+    start = time.monotonic()
+    try:
+        response = await get_client().get(url, headers=headers)
+    except asyncio.CancelledError:
+        # 调用方取消（例如批量接口超时）不算上游失败
+        _limiter.inflight -= 1
+        breaker.probing = False
+        raise
+    except Exception as e:
+        _limiter.release(False, time.monotonic() - start)
+        breaker.record_failure()
+        upstream_request_duration.observe(time.monotonic() - start, endpoint)
+        upstream_errors.inc(endpoint, type(e).__name__)
+        raise
+    elapsed = time.monotonic() - start
+    upstream_request_duration.observe(elapsed, endpoint)
+    ok = response.status_code < 500
+    _limiter.release(ok, elapsed)
+    if ok:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+        upstream_errors.inc(endpoint, f"http_{response.status_code}")
+    return response
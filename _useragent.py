@@ -0,0 +1,46 @@
+"""
+请求上游时使用的 User-Agent 池
+按大致的浏览器占比加权，启动时展开成一个元组，随机选择是 O(1) 的
+"""
+import os
+import random
+
+UA_STICKY = os.getenv("UA_STICKY", "false").lower() == "true"  # 每个 worker 固定使用一个 UA
+
+# (User-Agent, 权重)
+USER_AGENTS = (
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+     "Chrome/128.0.0.0 Safari/537.36", 30),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+     "Chrome/127.0.0.0 Safari/537.36", 12),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+     "Chrome/128.0.0.0 Safari/537.36", 12),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+     "Chrome/128.0.0.0 Safari/537.36 Edg/128.0.0.0", 10),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+     "Version/17.6 Safari/605.1.15", 8),
+    ("Mozilla/5.0 (iPhone; CPU iPhone OS 17_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+     "Version/17.6 Mobile/15E148 Safari/604.1", 8),
+    ("Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) "
+     "Chrome/128.0.0.0 Mobile Safari/537.36", 8),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:130.0) Gecko/20100101 Firefox/130.0", 5),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:130.0) Gecko/20100101 Firefox/130.0", 2),
+    ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+     "Chrome/128.0.0.0 Safari/537.36", 3),
+    ("Mozilla/5.0 (iPad; CPU OS 17_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+     "Version/17.6 Mobile/15E148 Safari/604.1", 2),
+)
+
+# 按权重展开，random.choice 直接按下标取
+_POOL = tuple(ua for ua, weight in USER_AGENTS for _ in range(weight))
+_sticky = random.choice(_POOL)
+
+
+def random_user_agent() -> str:
+    """
+    :return: 按权重随机的 User-Agent；UA_STICKY 时返回本 worker 固定的 User-Agent，
+             和 worker 的上游连接池一一对应，同一条 keep-alive 连接上不会出现不同的 UA
+    """
+    if UA_STICKY:
+        return _sticky
+    return random.choice(_POOL)
@@ -1,19 +1,24 @@
+import asyncio
 import datetime
 import hashlib
 import json
 import logging
+import os
+import time
 import urllib
 import uuid
 
-from fake_useragent import UserAgent
-from httpx import AsyncClient
+from fastapi_utils.tasks import repeat_every
 
-from _redis import get_key, set_key  # noqa
-
-ua = UserAgent()
+from _redis import get_key, redis_client, set_key  # noqa
+from _upstream import get_client
+from _useragent import random_user_agent
 
 logger = logging.getLogger(__name__)
 
+# 后台任务需要保持强引用，否则可能在执行完之前被 GC 回收
+_background_tasks = set()
+
 
 def he(char):
     # 将字符转换为二进制字符串，保持至少6位长度
@@ -25,14 +30,16 @@ def C(t):
     return hashlib.md5(t.encode('utf-8')).hexdigest()
 
 
-def vv_generator():
+def vv_generator(timestamp: int = None):
     """
     生成 vv 参数
+    :param timestamp: Unix 时间戳（秒），默认当前时间
     :return:
     """
-    # 获取当前法国时间的 Unix 时间戳（秒）
-    france_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2)))
-    timestamp = int(france_time.timestamp())
+    if timestamp is None:
+        # 获取当前法国时间的 Unix 时间戳（秒）
+        france_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2)))
+        timestamp = int(france_time.timestamp())
 
     # 将时间戳转换为字符串
     t = str(timestamp)
@@ -62,24 +69,82 @@ def vv_generator():
     return vv
 
 
+VV_BUCKET_SECONDS = int(os.getenv("VV_BUCKET_SECONDS", 60 * 5))
+
+# 推送任务队列（redis stream），由 _cronjobs 中的消费者组消费
+PUSH_STREAM = "pushTasks"
+PUSH_STREAM_MAXLEN = int(os.getenv("PUSH_STREAM_MAXLEN", 100000))
+
+
+class VVProvider:
+    """
+    vv 只和时间戳有关，按时间桶在本地计算并缓存，不再每次请求都读 redis
+    redis 中的 vv_override 作为可选的全局覆盖值，只在定时轮换时读取
+    """
+
+    def __init__(self, bucket_seconds: int = VV_BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self._tokens: dict = {}
+        self.override = None
+
+    def _bucket(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        return int(now) // self.bucket_seconds * self.bucket_seconds
+
+    def current(self) -> str:
+        """
+        当前时间桶的 vv
+        :return: str
+        """
+        if self.override:
+            return self.override
+        bucket = self._bucket()
+        vv = self._tokens.get(bucket)
+        if vv is None:
+            vv = self._tokens[bucket] = vv_generator(bucket)
+        return vv
+
+    def rotate(self, override: str = None):
+        """
+        预先计算当前和下一个时间桶的 vv，并清理过期的时间桶
+        :param override: redis 中的全局覆盖值
+        """
+        self.override = override or None
+        bucket = self._bucket()
+        for b in (bucket, bucket + self.bucket_seconds):
+            if b not in self._tokens:
+                self._tokens[b] = vv_generator(b)
+        for b in [b for b in self._tokens if b < bucket]:
+            del self._tokens[b]
+
+
+vvProvider = VVProvider()
+
+
+@repeat_every(seconds=VV_BUCKET_SECONDS, wait_first=VV_BUCKET_SECONDS)
+async def rotateVV():
+    """
+    定时轮换 vv，同时读取 redis 中的全局覆盖值
+    """
+    try:
+        override = await get_key('vv_override')
+    except Exception as e:
+        logger.error(f"Failed to read vv_override: {e}")
+        override = vvProvider.override
+    vvProvider.rotate(override)
+    return True
+
+
 async def generate_vv_detail():
     """
     生成 vv 参数
     :return:  str
     """
-    vv = await get_key('vv')
-
-    if not vv:
-        vv = vv_generator()
-        success = await set_key('vv', vv, 60 * 5)
-        if not success:
-            raise Exception('Failed to set vv')
-
-    return vv
+    return vvProvider.current()
 
 
 def _getRandomUserAgent():
-    return ua.random
+    return random_user_agent()
 
 
 async def pushNotification(baseURL: str, msg: str, icon: str = '', click_url: str = '', is_passive: bool = False,
@@ -107,13 +172,24 @@ async def pushNotification(baseURL: str, msg: str, icon: str = '', click_url: st
     if is_passive:
         url += f'&passive=true'
     print(f"Pushing to {url}")
-    async with AsyncClient() as client:
-        response = await client.post(url, headers=headers)
-        print(response.status_code)
-        if response.status_code != 200:
-            return False
-        else:
-            return True
+    response = await get_client("push").post(url, headers=headers)
+    print(response.status_code)
+    if response.status_code != 200:
+        return False
+    else:
+        return True
+
+
+def spawn(coro) -> asyncio.Task:
+    """
+    在后台执行协程，不阻塞当前请求
+    :param coro: coroutine
+    :return: asyncio.Task
+    """
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 
 # url 编码关键词
@@ -122,7 +198,7 @@ def url_encode(keyword):
 
 
 async def generatePushTask(baseURL: str, msg: str, user_id: str, receiver: str, icon=None, click_url=None,
-                           is_passive=None, headers: dict = None, taskID: str = uuid.uuid4().hex,
+                           is_passive=None, headers: dict = None, taskID: str = None,
                            push_receiver: str = "yuki", push_by: str = "system"):
     """
     :param push_by:  推送者 默认为system
@@ -141,6 +217,8 @@ async def generatePushTask(baseURL: str, msg: str, user_id: str, receiver: str,
                            "https://example.com", False, None, None, None, uuid.uuid4().hex, "system",
                             "bark")
     """
+    if not taskID:
+        taskID = uuid.uuid4().hex
     data = {
         "baseURL": baseURL,
         "msg": msg,
@@ -158,7 +236,8 @@ async def generatePushTask(baseURL: str, msg: str, user_id: str, receiver: str,
             "user_id": user_id
         }
     }
-    await set_key(f"pushTask:{taskID}", json.dumps(data), 60 * 5)
+    await redis_client.xadd(PUSH_STREAM, {"task_id": taskID, "payload": json.dumps(data)},
+                            maxlen=PUSH_STREAM_MAXLEN, approximate=True)
     return True
 
 
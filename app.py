@@ -1,3 +1,5 @@
+import asyncio
+import json
 import logging
 import os
 import random
@@ -7,7 +9,6 @@ import uuid
 from contextlib import asynccontextmanager
 
 import binascii
-import httpx
 import redis.asyncio as redis
 from asgi_correlation_id import CorrelationIdMiddleware
 from dotenv import load_dotenv
@@ -20,13 +21,20 @@ from fastapi_utils.tasks import repeat_every
 from starlette.middleware.sessions import SessionMiddleware
 
 from _auth import authRoute
-from _cronjobs import keepMySQLAlive, keerRedisAlive, pushTaskExecQueue
-from _crypto import cryptoRouter, init_crypto
-from _db import init_db, test_db_connection
-from _redis import get_keys_by_pattern, redis_client, set_key as redis_set_key
+from _cronjobs import flushPushLogs, keepMySQLAlive, keerRedisAlive, pushLogBuffer, pushQueueStats, \
+    startPushConsumer, stopPushConsumer
+from _crypto import cryptoRouter, decryptPool, init_crypto, refreshKeyRing
+from _db import init_db, test_db_connection, vodWriter
+from _localsearch import refreshLocalIndex
+from _metrics import flushMetrics, http_request_duration, metricsRouter, write_snapshot as write_metrics_snapshot
+from _profiler import PROFILER_TOKEN, RequestProfilerMiddleware, profilerRouter, start_profiler, stop_profiler
+from _redis import l1_stats, redis_client, set_key as redis_set_key, start_l1_invalidation, \
+    stop_l1_invalidation
 from _search import searchRouter
 from _trend import trendingRoute
+from _upstream import close_upstream, get_client, init_upstream, upstream_status
 from _user import userRoute
+from _utils import rotateVV
 
 load_dotenv()
 loglevel = os.getenv("LOG_LEVEL", "ERROR")
@@ -34,22 +42,75 @@ logging.basicConfig(level=logging.getLevelName(loglevel))
 logger = logging.getLogger(__name__)
 
 instanceID = uuid.uuid4().hex
+appVersion = "v1.1.4-" + os.getenv("COMMIT_ID", "")[:8]
+startedAt = int(time.time())
+
+# 实例注册表：有序集合 member 为实例 ID，score 为最后一次心跳时间；元数据存在 hash 中
+INSTANCE_REGISTRY_KEY = "nodes"
+INSTANCE_META_KEY = "nodes:meta"
+INSTANCE_HEARTBEAT_SECONDS = int(os.getenv("INSTANCE_HEARTBEAT_SECONDS", 60))
+INSTANCE_TTL = int(os.getenv("INSTANCE_TTL", 60 * 3))  # 超过该时间没有心跳视为下线
+HEALTH_CACHE_SECONDS = float(os.getenv("HEALTH_CACHE_SECONDS", 2))  # 健康检查结果的缓存时间
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", 1))  # 单个依赖检查的超时时间
+STARTUP_DEFER_SECONDS = float(os.getenv("STARTUP_DEFER_SECONDS", 1))  # worker 就绪后多久执行延后的启动步骤
+
+startupReport: dict = {}  # 各个启动步骤的耗时（毫秒）
+
+# 删除心跳超时的实例，返回删除数量
+_PRUNE_SCRIPT = """
+local dead = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1])
+if #dead > 0 then
+    redis.call('zrem', KEYS[1], unpack(dead))
+    redis.call('hdel', KEYS[2], unpack(dead))
+end
+return #dead
+"""
+
+
+def _instanceMeta(now: float) -> dict:
+    """
+    实例元数据
+    """
+    try:
+        load = round(os.getloadavg()[0], 2)
+    except OSError:
+        load = None
+    return {"version": appVersion, "pid": os.getpid(), "started_at": startedAt, "heartbeat": int(now),
+            "load": load}
 
 
-@repeat_every(seconds=60 * 3, wait_first=True)
+@repeat_every(seconds=INSTANCE_HEARTBEAT_SECONDS, wait_first=INSTANCE_HEARTBEAT_SECONDS)
 async def registerInstance():
     """
-    注册实例
+    注册实例（心跳），同时清理已经下线的实例
     :return:
     """
     try:
-        await redis_set_key(f"node:{instanceID}", str(int(time.time())), 60 * 3)  # re-register every 3 minutes
+        now = time.time()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd(INSTANCE_REGISTRY_KEY, {instanceID: now})
+            pipe.hset(INSTANCE_META_KEY, instanceID, json.dumps(_instanceMeta(now)))
+            pipe.eval(_PRUNE_SCRIPT, 2, INSTANCE_REGISTRY_KEY, INSTANCE_META_KEY, now - INSTANCE_TTL)
+            await pipe.execute()
     except Exception as e:
         logger.error(f"Failed to register instance: {e}", exc_info=True)
         exit(-1)
     return True
 
 
+async def unregisterInstance():
+    """
+    注销实例
+    """
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zrem(INSTANCE_REGISTRY_KEY, instanceID)
+            pipe.hdel(INSTANCE_META_KEY, instanceID)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to unregister instance: {e}")
+
+
 def is_valid_uuid4(uuid_string: str) -> bool:
     """
     检查是否是有效的 UUID4
@@ -67,8 +128,17 @@ async def getLiveInstances():
     :return:
     """
     try:
-        f = await get_keys_by_pattern("node:*")
-        return f
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(INSTANCE_REGISTRY_KEY, time.time() - INSTANCE_TTL, "+inf")
+            pipe.hgetall(INSTANCE_META_KEY)
+            ids, meta = await pipe.execute()
+        instances = []
+        for i in ids:
+            info = meta.get(i)
+            instance = json.loads(info) if info else {}
+            instance["id"] = i.decode()
+            instances.append(instance)
+        return instances
     except Exception as e:
         logger.error(f"Failed to get live instances: {e}", exc_info=True)
         return []
@@ -82,21 +152,47 @@ async def testPushServer():
     baseURL = os.getenv("PUSH_SERVER_URL", "").replace("https://", "").replace("http://", "")
     if not baseURL:
         return
-    async with httpx.AsyncClient() as client:
-        f = await client.get(f"https://{baseURL}/healthz")
-        if f.status_code == 200:
-            await redis_set_key("server_status", "running")
+    f = await get_client("push").get(f"https://{baseURL}/healthz")
+    if f.status_code == 200:
+        await redis_set_key("server_status", "running")
 
 
-@asynccontextmanager
-async def lifespan(_: FastAPI):
+async def _timed(name: str, coro):
     """
-    整个 FastAPI 生命周期的上下文管理器
-    :param _: FastAPI 实例
-    :return: None
-    :param _:
-    :return:
+    执行一个启动步骤并把耗时（毫秒）记入 startupReport
+    """
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        startupReport[name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+async def _startupStep(name: str, coro) -> bool:
+    """
+    执行一个启动步骤并计时，失败只记录日志，不影响后面的步骤
+    :return: 是否成功
     """
+    try:
+        await _timed(name, coro)
+        return True
+    except Exception as e:
+        logger.error(f"Startup step {name} failed: {e}", exc_info=True)
+        return False
+
+
+async def _startRepeating(name: str, job) -> bool:
+    """
+    repeat_every 包装的函数调用后只是把循环放到后台，不会等待执行：
+    先直接执行一次原函数并计时，再启动循环（这些循环带 wait_first，不会马上重复执行）
+    :return: 首次执行是否成功
+    """
+    ok = await _startupStep(name, job.__wrapped__())
+    await job()
+    return ok
+
+
+async def _initRedis():
     redis_connection = redis.from_url(
         f"redis://default:{os.getenv('REDIS_PASSWORD', '')}@{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}")
     await FastAPILimiter.init(redis_connection)
@@ -104,19 +200,76 @@ async def lifespan(_: FastAPI):
     if test:
         logger.info("Redis connection established")
     # await redis_connection.flush db()
+    await start_l1_invalidation()
+    await start_profiler()
+
+
+async def _initDB():
     if os.getenv("MYSQL_CONN_STRING"):
         await init_db()
         logger.info("MySQL connection established")
+
+
+async def _deferredStartup():
+    """
+    不影响处理请求的启动步骤，在 worker 开始接收请求之后再执行
+    """
+    await asyncio.sleep(STARTUP_DEFER_SECONDS)
+    await _startupStep("push_consumer", startPushConsumer())
+    await _startRepeating("local_index", refreshLocalIndex)
+    # 只启动定时循环，第一次执行在 wait_first 之后
     await testPushServer()
-    await registerInstance()
-    print("Instance registered", instanceID)
-    await pushTaskExecQueue()
     await keerRedisAlive()
     await keepMySQLAlive()
-    await init_crypto()
+    print("Deferred startup timing (ms)",
+          json.dumps({name: startupReport.get(name) for name in ("push_consumer", "local_index")}))
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """
+    整个 FastAPI 生命周期的上下文管理器
+    互不依赖的初始化步骤并发执行，可以延后的步骤放到 _deferredStartup
+    :param _: FastAPI 实例
+    :return: None
+    :param _:
+    :return:
+    """
+    started = time.perf_counter()
+    await _timed("upstream", init_upstream())
+    await asyncio.gather(
+        _timed("redis", _initRedis()),
+        _timed("mysql", _initDB()),
+        _timed("crypto", init_crypto()),
+        _timed("push_log_restore", pushLogBuffer.restore()),
+    )
+    vodWriter.start()
+    if await _startRepeating("register", registerInstance):
+        print("Instance registered", instanceID)
+    await _startRepeating("vv", rotateVV)
+    # 只启动定时循环，第一次执行在 wait_first 之后
+    await flushPushLogs()
+    await refreshKeyRing()
+    await flushMetrics()
+    startupReport["total"] = round((time.perf_counter() - started) * 1000, 1)
+    print("Startup timing (ms)", json.dumps(startupReport))
+    deferred = asyncio.get_running_loop().create_task(_deferredStartup())
     yield
+    deferred.cancel()
     await FastAPILimiter.close()
+    await unregisterInstance()
+    await stopPushConsumer()
+    await pushLogBuffer.close()
+    await vodWriter.stop()
+    await close_upstream()
+    decryptPool.shutdown()
+    await stop_l1_invalidation()
+    await stop_profiler()
     await redis_client.connection_pool.disconnect()
+    try:
+        write_metrics_snapshot()
+    except OSError:
+        pass
     print("Instance unregistered", instanceID)
     print("graceful shutdown")
 
@@ -129,6 +282,8 @@ app.include_router(userRoute)
 app.include_router(searchRouter)
 app.include_router(trendingRoute)
 app.include_router(cryptoRouter)
+app.include_router(metricsRouter)
+app.include_router(profilerRouter)
 
 
 @app.middleware("http")
@@ -150,7 +305,7 @@ async def test():
     测试接口
     :return:
     """
-    f = await get_keys_by_pattern("node:*")
+    f = await getLiveInstances()
     return f
 
 
@@ -160,9 +315,8 @@ async def index():
     首页
     :return:
     """
-    version_suffix = os.getenv("COMMIT_ID", "")[:8]
     info = {
-        "version": "v1.1.4-" + version_suffix,
+        "version": appVersion,
         "build_at": os.environ.get("BUILD_AT", ""),
         "author": "binaryYuki <noreply.tzpro.xyz>",
         "arch": subprocess.run(['uname', '-m'], stdout=subprocess.PIPE).stdout.decode().strip(),
@@ -186,41 +340,102 @@ async def index():
     return HTMLResponse(content=html)
 
 
+async def _timedCheck(check) -> tuple:
+    """
+    执行单个依赖检查
+    :param check: 无参数的协程函数，返回检查结果
+    :return: (结果, {"ok", "latency_ms", "error"})
+    """
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(check(), timeout=HEALTH_CHECK_TIMEOUT)
+        status = {"ok": True}
+    except asyncio.TimeoutError:
+        result, status = None, {"ok": False, "error": "timeout"}
+    except Exception as e:
+        result, status = None, {"ok": False, "error": str(e)}
+    status["latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result, status
+
+
+async def _runHealthChecks() -> dict:
+    """
+    并发检查所有依赖
+    """
+    (_, redisCheck), (_, mysqlCheck), (live_servers, liveCheck), (pushStats, pushCheck) = await asyncio.gather(
+        _timedCheck(redis_client.ping),
+        _timedCheck(test_db_connection),
+        _timedCheck(getLiveInstances),
+        _timedCheck(pushQueueStats),
+    )
+    for name, check in (("redis", redisCheck), ("mysql", mysqlCheck)):
+        if not check["ok"]:
+            logging.error("%s error: %s", name, check["error"])
+    live_servers = live_servers or []
+    liveCheck["ok"] = liveCheck["ok"] and bool(live_servers)
+    return {"redis": redisCheck, "mysql": mysqlCheck, "live_servers": live_servers, "nodes": liveCheck,
+            "push": pushStats, "push_queue": pushCheck, "checked_at": time.time()}
+
+
+_healthCache: dict = {"result": None, "expires": 0.0, "task": None}
+
+
+async def getHealth() -> dict:
+    """
+    依赖检查结果，缓存 HEALTH_CACHE_SECONDS 秒；缓存过期时并发的探测共享同一次检查
+    """
+    if _healthCache["result"] is not None and time.monotonic() < _healthCache["expires"]:
+        return _healthCache["result"]
+    task = _healthCache["task"]
+    if task is None or task.done():
+        task = _healthCache["task"] = asyncio.get_running_loop().create_task(_runHealthChecks())
+    result = await asyncio.shield(task)
+    _healthCache["result"], _healthCache["expires"] = result, time.monotonic() + HEALTH_CACHE_SECONDS
+    return result
+
+
+@app.get('/livez')
+async def livez():
+    """
+    存活检查：只要事件循环能响应就返回 200，不检查依赖
+    """
+    return JSONResponse(content={"status": "ok", "instance_id": instanceID})
+
+
+@app.get('/readyz')
+async def readyz():
+    """
+    就绪检查：redis 和 mysql 可用时返回 200，否则 503
+    """
+    health = await getHealth()
+    ready = health["redis"]["ok"] and health["mysql"]["ok"]
+    return JSONResponse(content={"status": "ok" if ready else "error", "redis": health["redis"],
+                                 "mysql": health["mysql"]}, status_code=200 if ready else 503)
+
+
 @app.api_route('/healthz', methods=['GET'])
 async def healthz():
     """
     健康检查
     :return:
     """
-    try:
-        await redis_client.ping()
-        redisStatus = True
-    except Exception as e:
-        redisStatus = False
-        logging.error("Redis error: %s", str(e))
-    # check mysql connection
-    try:
-        await test_db_connection()
-        mysqlStatus = True
-    except ConnectionError as e:
-        mysqlStatus = False
-        logging.error("MySQL connection error: %s", str(e))
-    except Exception as e:
-        mysqlStatus = False
-        logging.error("MySQL error: %s", str(e))
-    try:
-        live_servers = await getLiveInstances()
-    except Exception as e:
-        print(f"Error getting live servers: {e}")
-        live_servers = []
-    if redisStatus and mysqlStatus and live_servers:
-        return JSONResponse(content={"status": "ok", "redis": redisStatus, "mysql": mysqlStatus,
-                                     "live_servers": live_servers})
-    else:
-        return JSONResponse(content={"status": "error", "redis": redisStatus, "mysql": mysqlStatus,
-                                     "redis_hint": "An error occurred" if not redisStatus else "",
-                                     "mysql_hint": "An error occurred" if not mysqlStatus else "",
-                                     "live_servers": live_servers})
+    health = await getHealth()
+    redisStatus, mysqlStatus = health["redis"]["ok"], health["mysql"]["ok"]
+    checks = {name: health[name] for name in ("redis", "mysql", "nodes", "push_queue")}
+    content = {"status": "ok" if redisStatus and mysqlStatus and health["live_servers"] else "error",
+               "redis": redisStatus, "mysql": mysqlStatus, "live_servers": health["live_servers"],
+               "upstream": upstream_status(), "push": health["push"], "vod_writer": vodWriter.snapshot(),
+               "l1_cache": l1_stats(), "checks": checks, "startup": startupReport}
+    if content["status"] == "error":
+        content["redis_hint"] = "An error occurred" if not redisStatus else ""
+        content["mysql_hint"] = "An error occurred" if not mysqlStatus else ""
+    return JSONResponse(content=content)
+
+
+def _observeRequest(request, status: int, elapsed: float):
+    # 按路由模板分组（/detail/{id} 而不是每个 id 一组），未匹配的路径归到 unmatched
+    route = request.scope.get("route")
+    http_request_duration.observe(elapsed, request.method, getattr(route, "path", "unmatched"), str(status))
 
 
 @app.middleware("http")
@@ -232,8 +447,13 @@ async def add_process_time_header(request, call_next):
     :return:
     """
     start_time = time.time()
-    response = await call_next(request)
+    try:
+        response = await call_next(request)
+    except Exception:
+        _observeRequest(request, 500, time.time() - start_time)
+        raise
     process_time = time.time() - start_time
+    _observeRequest(request, response.status_code, process_time)
     # round it to 3 decimal places and add the unit which is seconds
     process_time = round(process_time, 3)
     response.headers["X-Process-Time"] = str(process_time) + "s"
@@ -249,6 +469,10 @@ app.add_middleware(SessionMiddleware, secret_key=secret_key,
                    session_cookie='session', max_age=60 * 60 * 12, same_site='lax', https_only=True)
 # noinspection PyTypeChecker
 app.add_middleware(GZipMiddleware, minimum_size=1000)
+if PROFILER_TOKEN:
+    # 包在 Session、GZip 和计时中间件外面，采样范围包括它们
+    # noinspection PyTypeChecker
+    app.add_middleware(RequestProfilerMiddleware)
 if os.getenv("DEBUG", "false").lower() == "false":
     # noinspection PyTypeChecker
     app.add_middleware(
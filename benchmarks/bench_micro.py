@@ -0,0 +1,155 @@
+"""
+热点函数的微基准测试：vv_generator、decryptData、cache_vod_data、pushTaskExecQueue
+
+- vv_generator：单次调用耗时
+- decryptData：当前 CRYPTO_EXECUTOR 下的单次解密耗时（并发吞吐见 bench_crypto.py）
+- cache_vod_data：写入 --rows 行搜索结果（首次插入 / 内容未变 / 内容有变化）
+- pushTaskExecQueue：--tasks 个推送任务写入 stream 后，消费者全部投递到 stub 推送服务的耗时
+
+用法：
+    python benchmarks/bench_micro.py
+    python benchmarks/bench_micro.py --benches vv,decrypt --iterations 20000 --json bench_micro.json
+    python benchmarks/bench_micro.py --benches push --tasks 5000 --latency 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import common  # noqa: E402
+
+BENCHES = ("vv", "decrypt", "cache_vod", "push")
+
+
+def _per_call(name: str, elapsed: float, calls: int, **extra) -> dict:
+    return {"name": name, "calls": calls, "ops_per_second": round(calls / elapsed, 1),
+            "us_per_op": round(elapsed / calls * 1e6, 3), **extra}
+
+
+async def bench_vv(args) -> list:
+    from _utils import vv_generator
+
+    vv_generator()
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        vv_generator()
+    return [_per_call("vv_generator", time.perf_counter() - start, args.iterations)]
+
+
+async def bench_decrypt(args) -> list:
+    import _crypto
+    from bench_crypto import _setup_keyring
+
+    data = _setup_keyring()
+    await _crypto.decryptData(data)
+    calls = max(args.iterations // 20, 50)
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await _crypto.decryptData(data)
+        latencies.append(time.perf_counter() - start)
+    _crypto.decryptPool.shutdown()
+    return [_per_call("decryptData", sum(latencies), calls, mode=_crypto.CRYPTO_EXECUTOR,
+                      **common.latency_stats(latencies))]
+
+
+async def bench_cache_vod(args) -> list:
+    from _db import cache_vod_data
+    from stub_olelive import search_response
+
+    def pages(suffix: str = ""):
+        # 每页 size 条，共 --rows 条，不同关键词的 id 不重叠
+        size = 50
+        for i in range(args.rows // size):
+            page = search_response(f"bench{i}", 1, size)
+            for item in page["data"]["data"][0]["list"]:
+                item["remarks"] += suffix
+            yield page
+
+    results = []
+    for name, suffix in (("cache_vod_data:insert", ""), ("cache_vod_data:unchanged", ""),
+                         ("cache_vod_data:update", " ")):
+        written = 0
+        batch = list(pages(suffix))
+        start = time.perf_counter()
+        for page in batch:
+            written += await cache_vod_data(page) or 0
+        elapsed = time.perf_counter() - start
+        rows = sum(len(p["data"]["data"][0]["list"]) for p in batch)
+        results.append({"name": name, "rows": rows, "written": written,
+                        "rows_per_second": round(rows / elapsed, 1), "elapsed_ms": round(elapsed * 1000, 3)})
+    return results
+
+
+async def bench_push(args) -> list:
+    import httpx
+
+    import _cronjobs
+    import _upstream
+    from _push import pushEngine
+    from _utils import generatePushTask
+    from stub_olelive import build_app
+
+    stub = build_app(args.latency / 1000)
+    await _upstream.init_upstream()
+    await _upstream._clients["push"].aclose()
+    _upstream._clients["push"] = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub))
+    for i in range(args.tasks):
+        # 分散到 8 个推送服务 host，和线上的 bark 服务器数量相当
+        await generatePushTask(f"http://push{i % 8}.stub/push/key{i}/", f"bench {i}", str(i), "bench")
+
+    delivered = pushEngine.delivered
+    start = time.perf_counter()
+    consumer = asyncio.get_running_loop().create_task(_cronjobs.pushTaskExecQueue())
+    while pushEngine.delivered - delivered < args.tasks and time.perf_counter() - start < args.timeout:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    consumer.cancel()
+    try:
+        await consumer
+    except asyncio.CancelledError:
+        pass
+    await _cronjobs.pushLogBuffer.close()
+    await _upstream.close_upstream()
+    done = pushEngine.delivered - delivered
+    return [{"name": "pushTaskExecQueue", "tasks": args.tasks, "delivered": done,
+             "tasks_per_second": round(done / elapsed, 1), "elapsed_ms": round(elapsed * 1000, 3),
+             "concurrency": pushEngine.concurrency, "per_host_limit": pushEngine.per_host}]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benches", default=",".join(BENCHES))
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--rows", type=int, default=5000, help="vod_info rows for cache_vod_data")
+    parser.add_argument("--tasks", type=int, default=2000, help="push tasks for pushTaskExecQueue")
+    parser.add_argument("--latency", type=float, default=0, help="stub push server latency in milliseconds")
+    parser.add_argument("--timeout", type=float, default=120)
+    common.add_backend_args(parser)
+    args = parser.parse_args()
+
+    # 推送消费者读取新任务时的阻塞时间，缩短以便任务投递完后尽快退出
+    os.environ.setdefault("PUSH_BLOCK_MS", "100")
+    redis_client = common.prepare(args)
+    await common.reset(redis_client, args)
+
+    from _db import init_db
+
+    await init_db()
+    benches = {"vv": bench_vv, "decrypt": bench_decrypt, "cache_vod": bench_cache_vod, "push": bench_push}
+    results = []
+    for name in args.benches.split(","):
+        for result in await benches[name.strip()](args):
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False))
+    await common.cleanup()
+    if args.json:
+        common.write_results(args.json, "micro", args, results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""
+基准测试的公共部分：后端选择（fakeredis / 本地 redis，SQLite / 本地 MySQL）、统计和结果文件
+
+prepare() 必须在导入项目模块之前调用：项目模块在导入时读取环境变量，并通过 from _redis import redis_client
+持有 redis 客户端。
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def add_backend_args(parser):
+    parser.add_argument("--redis", help="redis URL of a scratch database (FLUSHDB at start); default: fakeredis")
+    parser.add_argument("--mysql", help="MySQL URL; default: a fresh SQLite file")
+    parser.add_argument("--json", help="write results to this file")
+
+
+def prepare(args):
+    """
+    选择后端并设置环境变量
+    """
+    if args.mysql:
+        os.environ["MYSQL_CONN_STRING"] = args.mysql
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"oleapi-bench-{os.getpid()}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        os.environ["MYSQL_CONN_STRING"] = f"sqlite+aiosqlite:///{path}"
+    if args.redis:
+        os.environ["REDIS_CONN"] = args.redis
+    # 基准测试进程不写指标快照
+    os.environ.setdefault("METRICS_DIR", "")
+
+    import _redis
+    if not args.redis:
+        import fakeredis
+        from redis import asyncio as redis
+
+        pool = redis.ConnectionPool(connection_class=fakeredis.aioredis.FakeConnection, server=fakeredis.FakeServer())
+        _redis.redis_client = _redis._TimedRedis(connection_pool=pool)
+    return _redis.redis_client
+
+
+async def reset(redis_client, args):
+    if args.redis:
+        await redis_client.flushdb()
+
+
+async def cleanup():
+    from _db import engine
+    await engine.dispose()
+    if os.environ["MYSQL_CONN_STRING"].startswith("sqlite"):
+        path = os.environ["MYSQL_CONN_STRING"].split("///", 1)[1]
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def latency_stats(latencies: list) -> dict:
+    """
+    :param latencies: 秒
+    """
+    return {
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "latency_p90_ms": round(percentile(latencies, 0.9) * 1000, 3),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "latency_max_ms": round(max(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def write_results(path: str, benchmark: str, args, results: list):
+    """
+    结果文件带上提交和环境信息，用 benchmarks/compare.py 对比两次运行
+    """
+    with open(path, "w") as f:
+        json.dump({"benchmark": benchmark, "commit": _commit(), "time": int(time.time()),
+                   "python": platform.python_version(), "cpu_count": os.cpu_count(),
+                   "redis": "redis" if args.redis else "fakeredis",
+                   "database": "mysql" if args.mysql else "sqlite",
+                   "args": {k: v for k, v in vars(args).items() if k not in ("redis", "mysql", "json")},
+                   "results": results}, f, indent=2, ensure_ascii=False)
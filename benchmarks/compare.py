@@ -0,0 +1,53 @@
+"""
+对比两次基准测试的结果文件（--json 的输出）
+
+用法：
+    python benchmarks/compare.py before.json after.json
+    python benchmarks/compare.py before.json after.json --threshold 5
+"""
+import argparse
+import json
+
+
+def _key(result: dict) -> str:
+    return result.get("scenario") or result.get("name") or result.get("mode")
+
+
+def compare(before: dict, after: dict, threshold: float) -> list:
+    """
+    :return: [(结果, 指标, 之前, 之后, 变化百分比)]，只包含变化超过 threshold% 的数值指标
+    """
+    rows = []
+    previous = {_key(r): r for r in before["results"]}
+    for result in after["results"]:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        for metric, value in result.items():
+            base = old.get(metric)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(base, (int, float)):
+                continue
+            change = (value - base) / base * 100 if base else 0.0
+            if abs(change) >= threshold:
+                rows.append((_key(result), metric, base, value, change))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0, help="only show changes of at least this many percent")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"{before.get('benchmark')}: {before.get('commit') or '?'} -> {after.get('commit') or '?'}")
+    for name, metric, base, value, change in compare(before, after, args.threshold):
+        print(f"{name:<28} {metric:<22} {base:>12} {value:>12} {change:>+8.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+olelive 上游的本地替身，用于基准测试
+
+提供 search / keywords / detail / rank / hot 接口和一个 bark 风格的推送接口（/push/...），
+响应内容由参数确定性生成（同一个关键词总是得到同样的片单），可以设置固定的响应延迟。
+既可以作为 ASGI app 在进程内使用（httpx.ASGITransport），也可以单独启动：
+
+用法：
+    python benchmarks/stub_olelive.py --port 9000 --latency 20
+    python benchmarks/bench_app.py --upstream http://127.0.0.1:9000
+"""
+import argparse
+import asyncio
+import hashlib
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+TITLES = ("进击的巨人", "海贼王", "火影忍者", "间谍过家家", "鬼灭之刃", "咒术回战", "葬送的芙莉莲", "孤独摇滚",
+          "三体", "狂飙", "繁花", "庆余年", "漫长的季节", "流浪地球", "满江红", "封神第一部")
+
+
+def _seed(*parts) -> int:
+    return int(hashlib.md5("/".join(map(str, parts)).encode()).hexdigest()[:8], 16)
+
+
+def vod_item(vod_id: int, name: str) -> dict:
+    return {"id": vod_id, "name": name, "typeId": 2, "typeId1": vod_id % 4 + 1, "remarks": f"更新至{vod_id % 40 + 1}集",
+            "vip": vod_id % 5 == 0, "episodes": vod_id % 40 + 1, "pic": f"https://static.example.com/{vod_id}.jpg",
+            "new": vod_id % 7 == 0, "version": "", "score": round(vod_id % 100 / 10, 1), "year": 2000 + vod_id % 25}
+
+
+def search_response(keyword: str, page: int = 1, size: int = 4) -> dict:
+    """
+    :return: 与上游搜索接口相同结构的响应，total 和片单由关键词决定
+    """
+    seed = _seed(keyword)
+    total = seed % 50 + size
+    start = (page - 1) * size
+    items = [vod_item(seed % 100000 * 100 + i, f"{keyword}{TITLES[(seed + i) % len(TITLES)]}{i}")
+             for i in range(start, min(start + size, total))]
+    return {"code": 0, "data": {"total": total, "data": [{"type": "vod", "list": items}]}, "msg": "ok"}
+
+
+def build_app(latency: float = 0.0) -> Starlette:
+    """
+    :param latency: 每个请求的固定延迟（秒）
+    """
+    calls = {}
+
+    async def respond(name: str, content):
+        calls[name] = calls.get(name, 0) + 1
+        if latency:
+            await asyncio.sleep(latency)
+        return JSONResponse(content)
+
+    async def search(request: Request):
+        p = request.path_params
+        return await respond("search", search_response(p["keyword"], int(p["page"]), int(p["size"])))
+
+    async def keywords(request: Request):
+        keyword = request.path_params["keyword"]
+        words = [f"{keyword}{TITLES[(_seed(keyword) + i) % len(TITLES)]}" for i in range(8)]
+        return await respond("keywords", {"code": 0, "data": [{"type": "vod", "words": words}], "msg": "ok"})
+
+    async def detail(request: Request):
+        vod_id = int(request.path_params["id"])
+        return await respond("detail", {"code": 0, "data": {**vod_item(vod_id, TITLES[vod_id % len(TITLES)]),
+                                                          "urls": [{"title": f"第{i + 1}集", "url": f"/play/{vod_id}/{i}"}
+                                                                   for i in range(vod_id % 40 + 1)]},
+                                        "msg": "ok"})
+
+    async def rank(request: Request):
+        p = request.path_params
+        items = [vod_item(_seed(p["period"], p["typeID"]) % 1000 * 100 + i, TITLES[i % len(TITLES)])
+                 for i in range(int(p["amount"]))]
+        return await respond("rank", {"code": 0, "data": items, "msg": "ok"})
+
+    async def hot(request: Request):
+        p = request.path_params
+        items = [vod_item(_seed("hot", p["typeID"]) % 1000 * 100 + i, TITLES[i % len(TITLES)])
+                 for i in range(int(p["amount"]))]
+        return await respond("hot", {"code": 0, "data": items, "msg": "ok"})
+
+    async def push(request: Request):
+        return await respond("push", {"code": 200, "message": "success"})
+
+    app = Starlette(routes=[
+        Route("/v1/pub/index/search/keywords/{keyword}", keywords),
+        Route("/v1/pub/index/search/{keyword}/vod/0/{page}/{size}", search),
+        Route("/v1/pub/vod/detail/{id}/true", detail),
+        Route("/v1/pub/index/vod/data/rank/{period}/{typeID}/{amount}", rank),
+        Route("/v1/pub/index/vod/hot/{typeID}/0/{amount}", hot),
+        Route("/push/{path:path}", push, methods=["GET", "POST"]),
+    ])
+    app.state.calls = calls
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0, help="response latency in milliseconds")
+    args = parser.parse_args()
+    uvicorn.run(build_app(args.latency / 1000), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,44 @@
+"""
+测试使用 fakeredis 和临时 SQLite 文件（pip install pytest fakeredis aiosqlite）
+项目模块在导入时读取环境变量并持有 redis 客户端，所以要在导入任何项目模块之前完成设置
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+DB_PATH = os.path.join(tempfile.gettempdir(), f"oleapi-test-{os.getpid()}.db")
+os.environ["MYSQL_CONN_STRING"] = f"sqlite+aiosqlite:///{DB_PATH}"
+os.environ["METRICS_DIR"] = ""
+os.environ.setdefault("PUSH_BLOCK_MS", "100")
+
+import fakeredis  # noqa: E402
+import pytest  # noqa: E402
+from redis import asyncio as redis  # noqa: E402
+
+import _redis  # noqa: E402
+
+_redis.redis_client = _redis._TimedRedis(connection_pool=redis.ConnectionPool(
+    connection_class=fakeredis.aioredis.FakeConnection, server=fakeredis.FakeServer()))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def backends():
+    """
+    每个测试使用空的 redis 和新建的数据库
+    """
+    from _db import engine, init_db
+
+    await init_db()
+    yield _redis.redis_client
+    await _redis.redis_client.flushall()
+    await _redis.redis_client.connection_pool.disconnect()
+    await engine.dispose()
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy import select
+
+from _db import VOD_HASH_KEY, VOD_HASH_TTL, SessionLocal, VodInfo, upsert_vod_rows, vod_rows
+
+pytestmark = pytest.mark.anyio
+
+
+def _search(*items) -> dict:
+    return {"code": 0, "data": {"total": len(items), "data": [{"type": "vod", "list": list(items)}]}, "msg": "ok"}
+
+
+def _item(vod_id: int, remarks: str) -> dict:
+    return {"id": vod_id, "name": f"片名{vod_id}", "typeId": 2, "typeId1": 2, "remarks": remarks, "vip": False}
+
+
+async def _remarks() -> dict:
+    async with SessionLocal() as session:
+        result = await session.execute(select(VodInfo.vod_id, VodInfo.vod_remarks))
+        return dict(result.all())
+
+
+async def test_upsert_inserts_skips_unchanged_and_updates(backends):
+    assert await upsert_vod_rows(vod_rows(_search(_item(1, "更新至1集"), _item(2, "完结")))) == 2
+    assert await _remarks() == {"1": "更新至1集", "2": "完结"}
+
+    assert await upsert_vod_rows(vod_rows(_search(_item(1, "更新至1集"), _item(2, "完结")))) == 0
+
+    assert await upsert_vod_rows(vod_rows(_search(_item(1, "更新至2集"), _item(2, "完结")))) == 1
+    assert await _remarks() == {"1": "更新至2集", "2": "完结"}
+
+
+async def test_content_hashes_expire_per_row(backends):
+    await upsert_vod_rows(vod_rows(_search(_item(1, "完结"), _item(2, "完结"))))
+    for vod_id in ("1", "2"):
+        assert 0 < await backends.ttl(VOD_HASH_KEY + vod_id) <= VOD_HASH_TTL
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import _cronjobs
+import _upstream
+from _push import PushDeliveryEngine
+from _utils import generatePushTask
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_flood_for_one_host_does_not_delay_other_hosts(backends, monkeypatch):
+    delivered = {}
+
+    async def handler(request: httpx.Request):
+        if request.url.host == "busy.example":
+            await asyncio.sleep(0.2)
+        delivered.setdefault(request.url.host, []).append(time.perf_counter())
+        return httpx.Response(200)
+
+    monkeypatch.setitem(_upstream._clients, "push", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(_cronjobs, "pushEngine", PushDeliveryEngine(concurrency=4, per_host=2))
+    # busy host 每次 0.2 秒、并发 2，40 条要 4 秒；排在后面的 idle host 任务不应该等它们
+    for i in range(40):
+        await generatePushTask("http://busy.example/key/", f"busy {i}", str(i), "test")
+    for i in range(4):
+        await generatePushTask("http://idle.example/key/", f"idle {i}", str(i), "test")
+
+    start = time.perf_counter()
+    consumer = asyncio.get_running_loop().create_task(_cronjobs.pushTaskExecQueue())
+    try:
+        while len(delivered.get("idle.example", [])) < 4 and time.perf_counter() - start < 5:
+            await asyncio.sleep(0.01)
+    finally:
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        await _cronjobs.pushLogBuffer.flush()
+
+    assert len(delivered.get("idle.example", [])) == 4
+    assert delivered["idle.example"][-1] - start < 1
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+
+from _cronjobs import PushLogBuffer, _pushLogRow
+from _db import PushLog, SessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+def _row(push_id: str, **overrides) -> dict:
+    data = {"msg": f"message {push_id}", "log_data": {"push_receiver": "user@example.com"}, "result": "success"}
+    return {**_pushLogRow(push_id, data), **overrides}
+
+
+async def _count() -> int:
+    async with SessionLocal() as session:
+        return await session.scalar(select(func.count()).select_from(PushLog))
+
+
+def test_row_is_truncated_to_column_widths():
+    row = _pushLogRow("a" * 40, {"msg": "x" * 300, "log_data": {"push_receiver": "r" * 50}, "result": "success"})
+    assert len(row["push_id"]) == 32
+    assert len(row["push_message"]) == 256
+    assert len(row["push_receiver"]) == 36
+
+
+async def test_bad_row_is_dropped_instead_of_blocking_the_buffer(backends):
+    buffer = PushLogBuffer(batch_size=10)
+    for row in (_row("1"), _row("2", push_at="not a datetime"), _row("3")):
+        buffer.add(row)
+    assert await buffer.flush() == 2
+    assert len(buffer) == 0
+    assert buffer.dropped == 1
+    assert await _count() == 2
+
+    buffer.add(_row("4"))
+    assert await buffer.flush() == 1
+    assert await _count() == 3
+
+
+async def test_rows_stay_buffered_when_the_database_is_unreachable(backends, monkeypatch):
+    async def unreachable(rows):
+        raise OperationalError("INSERT", {}, ConnectionRefusedError("connection refused"))
+
+    buffer = PushLogBuffer(batch_size=2)
+    monkeypatch.setattr(buffer, "_insert", unreachable)
+    for i in range(3):
+        buffer.add(_row(str(i), push_at=datetime.now()))
+    assert await buffer.flush() == 0
+    assert len(buffer) == 3
+    assert buffer.dropped == 0
+
+    monkeypatch.undo()
+    assert await buffer.flush() == 3
+    assert await _count() == 3